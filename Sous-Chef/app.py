@@ -1,27 +1,112 @@
-from flask import Flask, redirect, render_template, session, flash, g, request, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, Blueprint, Response, current_app, redirect, render_template, stream_template, session, flash, get_flashed_messages, g, request, jsonify
+from flask.cli import with_appcontext
+# from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import func, case
+from sqlalchemy.orm import selectinload
+from werkzeug.local import LocalProxy
+from requests import RequestException
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from sqlalchemy.exc import IntegrityError
-from models import db, connect_db, User, Favorite, Review, Order
+from models import db, connect_db, User, Favorite, Review, RecipeRatingSummary, Order, OrderItem, CartItem, CachedRecipe
+from cache import recipe_cache, user_recipe_ids
+from spoonacular import spoonacular
+from quota import QuotaExceeded
+from passwords import password_pool, login_limiter, PasswordQueueFull
+from metrics import performance
+from prefetch import random_recipes
+from search import recipe_index, ingredient_index
+from ingredients import ingredient_lookup
+from pages import page_cache
+from jobs import job_queue
+from images import image_proxy
 from forms import RegisterForm, LoginForm, IngredientSubsForm, EditProfileForm, ShopIngredientsForm, FilterRecipesForm
 from keys import spoonacular_key, db_url
-import json
-import requests
+import click
 import random
 import decimal
 import os
 
 
-app = Flask(__name__)
-app.app_context().push()
-# app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///sous_chef')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', db_url)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'Sous-Chef')
+main = Blueprint('main', __name__)
+
+recipe_cache.on_store(recipe_index.add_many)
+recipe_cache.on_store(ingredient_index.add_many)
+recipe_cache.on_store(ingredient_lookup.add_names)
+
+
+def create_app(config=None):
+    """Build the app. Nothing here touches the database, run `flask migrate` to create or update the schema."""
+    app = Flask(__name__)
+    # app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///sous_chef')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', db_url)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO') == '1'
+    # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'Sous-Chef')
+    app.config['SPOONACULAR_KEY'] = os.environ.get('SPOONACULAR_KEY', spoonacular_key)
+    app.config['SPOONACULAR_URL'] = os.environ.get('SPOONACULAR_URL', 'https://api.spoonacular.com')
+    app.config['SPOONACULAR_DAILY_POINTS'] = float(os.environ.get('SPOONACULAR_DAILY_POINTS', 150))
+    app.config['ORDERS_PER_PAGE'] = 10
+    app.config['NUTRITION_TIMEOUT'] = 3
+    app.config['SEARCH_RESULTS'] = 10
+    app.config['SEARCH_MIN_RESULTS'] = 5
+    app.config['RESOURCEFUL_MIN_RESULTS'] = 10
+    app.config['PROFILE_STREAM_CHUNK'] = 10
+    app.config['REVIEWS_PER_PAGE'] = 10
+    app.config.update(config or {})
+
+    connect_db(app)
+    recipe_cache.init_app(app)
+    user_recipe_ids.init_app(app)
+    spoonacular.init_app(app)
+    random_recipes.init_app(app)
+    ingredient_lookup.init_app(app)
+    password_pool.init_app(app)
+    login_limiter.init_app(app)
+    page_cache.init_app(app)
+    job_queue.init_app(app)
+    image_proxy.init_app(app)
+    performance.init_app(app)
+    performance.add_stats('recipe_cache', recipe_cache.stats)
+    performance.add_stats('spoonacular_quota', spoonacular.quota.stats)
+    performance.add_stats('passwords', password_pool.stats)
+    performance.add_stats('page_cache', page_cache.stats)
+    performance.add_stats('user_recipe_ids', user_recipe_ids.stats)
+    performance.add_stats('jobs', job_queue.stats)
+    performance.add_stats('images', image_proxy.stats)
+
+    app.register_blueprint(main)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(worker_command)
+
+    return app
+
+
+def reset_after_fork(app):
+    """Drop connections and threads inherited from the parent process, for gunicorn --preload workers"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+    spoonacular.reset()
+    random_recipes.reset()
+    password_pool.reset()
+    image_proxy.reset()
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """Create missing tables and bring existing ones up to date"""
+    from migrations import run_migrations
+    run_migrations()
+
+
+@click.command('worker')
+@click.option('--processes', default=2, help='worker processes to run jobs in')
+@with_appcontext
+def worker_command(processes):
+    """Run queued background jobs until stopped"""
+    job_queue.run(create_app, processes, after_fork=reset_after_fork)
 
-connect_db(app)
-db.create_all()
 
 # debug = DebugToolbarExtension(app)
 
@@ -29,13 +114,41 @@ current_user = "curr_user"
 
 # Account actions ********************************************************************************
 
-@app.before_request
+@main.app_errorhandler(QuotaExceeded)
+def quota_exceeded(error):
+    """Spoonacular points are used up and nothing cached could stand in"""
+    return "Recipes are unavailable right now, please try again later.", 503
+
+
+@main.app_errorhandler(RequestException)
+def spoonacular_failed(error):
+    """Spoonacular couldn't be reached or answered with an error, and nothing cached could stand in"""
+    current_app.logger.warning('Spoonacular request failed: %s', error)
+    return "Recipes are unavailable right now, please try again later.", 503
+
+
+@main.app_errorhandler(PasswordQueueFull)
+def password_queue_full(error):
+    """Too many logins are already waiting on the password pool"""
+    return "Too many people are signing in right now, please try again in a moment.", 503
+
+
+def get_current_user():
+    """Load the logged in user the first time it's needed in a request"""
+    if '_current_user' not in g:
+        if current_user in session:
+            g._current_user = db.session.get(User, session[current_user])
+        else:
+            g._current_user = None
+
+    return g._current_user
+
+
+@main.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-    if current_user in session:
-        g.user = User.query.get(session[current_user])
-    else:
-        g.user = None
+    """If we're logged in, add curr user to Flask global. The user isn't queried until it's used."""
+    g.pop('_current_user', None)
+    g.user = LocalProxy(get_current_user)
 
 
 def do_login(user):
@@ -48,9 +161,57 @@ def do_logout():
     if current_user in session:
         del session[current_user]
 
+
+def get_recipe_info(recipe_id):
+    """Get recipe info from the recipe cache, only going to Spoonacular on a miss"""
+    return recipe_cache.get(recipe_id, spoonacular.recipe_information)
+
+
+def get_recipes_info(recipe_ids):
+    """Get info for many recipes at once, fetching everything not cached in bulk"""
+    return recipe_cache.get_many(recipe_ids, spoonacular.recipe_information_bulk)
+
+
+def ingredient_image_url(image):
+    """Spoonacular CDN URL for an ingredient image file name. Full URLs and empty values are returned as they are."""
+    if not image or image.startswith(('http://', 'https://', '/')):
+        return image
+    return f"https://spoonacular.com/cdn/ingredients_100x100/{ image }"
+
+
+def lookup_ingredients(ingredient_ids):
+    """Get {id: (name, image url)} for ingredients, looking each distinct id up once"""
+    ingredient_ids = list(set(ingredient_ids))
+    ingredients = {}
+
+    for id, ingredient_info in zip(ingredient_ids, spoonacular.ingredient_information_many(ingredient_ids)):
+        ingredients[id] = (ingredient_info.get('originalName', ingredient_info['name']), ingredient_image_url(ingredient_info['image']))
+
+    return ingredients
+
+
+def index_recipes(recipes):
+    """Add fetched recipes to the local search indexes"""
+    recipe_index.add_many(recipes)
+    ingredient_index.add_many(recipes)
+    ingredient_lookup.add_names(recipes)
+
+
+def snapshot_ingredients(items):
+    """Save ingredient name and image on order items that don't have them yet"""
+    missing = [item for item in items if item.ingredient_name is None]
+
+    if len(missing) > 0:
+        ingredients = lookup_ingredients([item.ingredient_id for item in missing])
+
+        for item in missing:
+            item.ingredient_name, item.ingredient_image = ingredients[item.ingredient_id]
+
+    return missing
+
 # User Account Info ********************************************************************************
 
-@app.route('/register', methods=["GET", "POST"])
+@main.route('/register', methods=["GET", "POST"])
 def register():
     """Load register form if nobody is logged in"""
     form = RegisterForm()
@@ -82,7 +243,7 @@ def register():
         return redirect('/')  
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     """Load login form if nobody is logged in"""
     form = LoginForm()
@@ -94,6 +255,7 @@ def login():
                 form.password.data
             )
             if user:
+                db.session.commit()
                 do_login(user)
                 flash(f"Hello, {user.username}!", "success")
                 return redirect("/")
@@ -106,7 +268,7 @@ def login():
         return redirect('/')
 
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     """Log user out"""
     session.pop(current_user)
@@ -114,103 +276,177 @@ def logout():
     return redirect('/login')
 
 
-@app.route("/")
+@main.route("/")
 def homepage():
     """Display homepage"""
 
     return render_template('index.html')
 
 
-@app.route('/user/<int:user_id>')
+@main.route('/user/<int:user_id>')
 def profile(user_id):
-    """Get favorite recipes and reviews for the specified user and display them on their profile"""
-    if user_id == g.user.id:
-        user = User.query.get(user_id)
-    else:
-        user = User.query.get(user_id)
+    """Show favorite recipes and reviews for the specified user, streaming cards as their recipe info arrives"""
+    user = (User.query
+                .options(selectinload(User.favorites))
+                .get_or_404(user_id))
 
     favorites = [recipe.recipe_id for recipe in user.favorites]
-    favorite_recipes = []
-
-    for id in favorites:
-        res = requests.get(f'https://api.spoonacular.com/recipes/{ id }/information',
-                               params={
-                                'apiKey': spoonacular_key,
-                                'id': id
-                               }).text
-
-        recipe_info = json.loads(res)
-        fixed_recipe = {
-            'id': recipe_info['id'],
-            'title': recipe_info['title'],
-            'sourceUrl': recipe_info['sourceUrl'],
-            'image': recipe_info.get('image', '/static/images/def_img.png'),
-            'summary': recipe_info['summary'],
-            'tags': {
-                'Vegetarian': recipe_info['vegetarian'],
-                'Vegan': recipe_info['vegan'],
-                'Gluten Free': recipe_info['glutenFree'],
-                'Dairy Free': recipe_info['dairyFree'],
-                'Very Healthy': recipe_info['veryHealthy'],
-                'Cheap': recipe_info['cheap'],
-                'Very Popular': recipe_info['veryPopular'],
-                'Sustainable': recipe_info['sustainable']
-            }
-        }
 
-        favorite_recipes.append(fixed_recipe)
-
-    reviewed_recipes = [recipe.recipe_id for recipe in user.reviews]
-    reviews = []
-    for id in reviewed_recipes:
-        res = requests.get(f'https://api.spoonacular.com/recipes/{ id }/information',
-                               params={
-                                'apiKey': spoonacular_key,
-                                'id': id
-                               }).text
-        
-        recipe_info = json.loads(res)
-
-
-        modified_info = {
-            'id': recipe_info['id'],
-            'title': recipe_info['title'],
-            'image': recipe_info.get('image', '/static/images/def_img.png'),
-            'rating': Review.query.filter(Review.recipe_id == recipe_info['id']).first().rating,
-            'comment': Review.query.filter(Review.recipe_id == recipe_info['id']).first().comment
+    return stream_page('user/profile.html', user=user, recipes=StreamedList(favorite_cards(favorites)), favorites=favorites, reviews=StreamedList(review_cards(user.id)))
+
+
+def favorite_cards(favorites):
+    """Cards for favorite recipes, fetching info PROFILE_STREAM_CHUNK recipes at a time"""
+    chunk = current_app.config['PROFILE_STREAM_CHUNK']
+
+    for start in range(0, len(favorites), chunk):
+        ids = favorites[start:start + chunk]
+        recipes_info = get_recipes_info(ids)
+
+        for id in ids:
+            recipe_info = recipes_info.get(id)
+            if recipe_info is not None:
+                yield recipe_card(recipe_info)
+
+
+def review_cards(user_id):
+    """The user's reviews, newest first, with the title and image of each recipe"""
+
+    """Reviews are loaded in one query, joined to the cached title and image of each recipe"""
+    user_reviews = (db.session.query(Review.recipe_id,
+                                     Review.rating,
+                                     Review.comment,
+                                     CachedRecipe.title,
+                                     CachedRecipe.image)
+                              .outerjoin(CachedRecipe, CachedRecipe.recipe_id == Review.recipe_id)
+                              .filter(Review.user_id == user_id)
+                              .order_by(Review.id.desc())
+                              .all())
+
+    uncached = get_recipes_info([review.recipe_id for review in user_reviews if review.title is None])
+
+    for review in user_reviews:
+        if review.title is None:
+            recipe_info = uncached.get(review.recipe_id, {})
+            title, image = recipe_info.get('title'), recipe_info.get('image')
+        else:
+            title, image = review.title, review.image
+
+        yield {
+            'id': review.recipe_id,
+            'title': title,
+            'image': image_proxy.url(image, 'card') or '/static/images/def_img.png',
+            'rating': review.rating,
+            'comment': review.comment
         }
 
-        reviews.append(modified_info)
-    
-    return render_template('user/profile.html', user=user, recipes=favorite_recipes, favorites=favorites, reviews=reviews)
 
+def stream_page(template, **context):
+    """Send a template as it renders, so the browser gets the top of the page while the rest is still loading.
 
-@app.route('/user/edit', methods=['GET', 'POST'])
-def edit_profile():
-    user = User.query.get_or_404(g.user.id)
-    form = EditProfileForm()
+    Flashed messages are taken out of the session up front, because the session is
+    saved before the first byte of a streamed body is sent.
+    """
+    get_flashed_messages()
+    response = Response(stream_template(template, **context))
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class StreamedList:
+    """A list filled from a generator as a template loops over it.
+
+    Truthiness only reads the first item, and len() or indexing reads as much as it needs,
+    so templates written for a list keep working while a plain for loop still streams.
+    """
+
+    def __init__(self, items):
+        self._items = iter(items)
+        self._read = []
 
+    def __iter__(self):
+        index = 0
+        while self._fill(index + 1):
+            yield self._read[index]
+            index += 1
+
+    def __bool__(self):
+        return self._fill(1)
+
+    def __len__(self):
+        self._fill(None)
+        return len(self._read)
+
+    def __getitem__(self, index):
+        self._fill(None if isinstance(index, slice) or index < 0 else index + 1)
+        return self._read[index]
+
+    def _fill(self, count):
+        """Read items until there are count of them (or all of them for None), returning whether there are"""
+        while count is None or len(self._read) < count:
+            item = next(self._items, StopIteration)
+            if item is StopIteration:
+                break
+            self._read.append(item)
+        return count is None or len(self._read) >= count
+
+
+class StreamedOrders(StreamedList):
+    """(order id, order) pairs read like a dict of orders keyed by id, in page order"""
+
+    def __init__(self, order_ids, pairs):
+        super().__init__(pairs)
+        self._ids = list(order_ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __bool__(self):
+        return len(self._ids) > 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, order_id):
+        return order_id in self._ids
+
+    def __getitem__(self, order_id):
+        self._fill(self._ids.index(order_id) + 1)
+        return self._read[self._ids.index(order_id)][1]
+
+    def get(self, order_id, default=None):
+        return self[order_id] if order_id in self._ids else default
+
+    def keys(self):
+        return iter(self._ids)
+
+    def items(self):
+        return StreamedList.__iter__(self)
+
+    def values(self):
+        return (order for order_id, order in self.items())
+
+
+@main.route('/user/edit', methods=['GET', 'POST'])
+def edit_profile():
     if not g.user:
         flash("Access unauthorized.", "danger")
-        return redirect(f'/user/{ g.user.id }')
+        return redirect('/login')
+
+    user = get_current_user()
+    form = EditProfileForm()
     
     if form.validate_on_submit():
-        if form.username.data:
-            user.username = form.username.data
-        else:
-            user.username = user.username
+        if user.check_password(form.password.data):
+            if form.username.data:
+                user.username = form.username.data
 
-        if form.email.data:
-            user.email = form.email.data
-        else:
-            user.email = user.email
+            if form.email.data:
+                user.email = form.email.data
 
-        if form.profile_pic.data:
-            user.profile_pic = form.profile_pic.data
-        else:
-            user.profile_pic = user.profile_pic
+            if form.profile_pic.data:
+                user.profile_pic = form.profile_pic.data
 
-        if User.authenticate(form.username.data, form.password.data):
             db.session.commit()
             flash('Profile Modified!', 'success')
             return redirect(f'/user/{ user.id }')
@@ -220,174 +456,261 @@ def edit_profile():
     return render_template('user/profile-edit.html', form=form, user=user)
 
 
-@app.route('/user/cart/load', methods=['POST'])
+@main.route('/user/cart/load', methods=['GET', 'POST'])
 def load_user_cart():
-    cart_info = []
-    data = request.json.get('cart')
+    """Return the user's cart and its total, straight from the cart table"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect('/login')
 
-    if len(data) > 0:
-        for item in data:
-            res = requests.get(f'https://api.spoonacular.com/food/ingredients/{ item["id"] }/information',
-               params={
-                'apiKey': spoonacular_key,
-               }).text
-
-            ingredient_info = json.loads(res)
-
-            info = {
-                'id': item['id'],
-                'name': ingredient_info['name'],
-                'image': f"https://spoonacular.com/cdn/ingredients_100x100/{ ingredient_info['image'] }",
-                'count': item['count'],
-                'price': item['price'],
-                'total': decimal.Decimal(float(item['count']) * float(item['price'])).quantize(decimal.Decimal('0.00'))
-                  
-            }
-
-            cart_info.append(info)
-
-    cart_total = 0
-    for item in cart_info:
-        cart_total = cart_total + item['total']
-
-    results = {
-        'cart_items': cart_info,
-        'cart_total': decimal.Decimal(cart_total).quantize(decimal.Decimal('0.00'))
+    merge_browser_cart(g.user.id, request.json.get('cart') if request.is_json else None)
+
+    return jsonify(cart_json(cart_items(g.user.id)))
+
+
+@main.route('/user/cart/add', methods=['POST'])
+def add_user_cart():
+    """Add ingredients to the cart, or more of ones already in it"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect('/login')
+
+    add_to_cart(g.user.id, request.json.get('items'))
+
+    return jsonify(cart_json(cart_items(g.user.id)))
+
+
+@main.route('/user/cart/update', methods=['POST'])
+def update_user_cart():
+    """Change how many of an ingredient are in the cart, removing it at zero"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect('/login')
+
+    ingredient_id = int(request.json['id'])
+    count = int(request.json['count'])
+
+    item = CartItem.query.filter(CartItem.user_id == g.user.id, CartItem.ingredient_id == ingredient_id).first()
+    if item and count > 0:
+        item.set_count(count)
+    elif item:
+        db.session.delete(item)
+    db.session.commit()
+
+    return jsonify(cart_json(cart_items(g.user.id)))
+
+
+def merge_browser_cart(user_id, data):
+    """Merge a cart still kept in the browser, once per user.
+
+    Later requests may still post the old browser cart, but by then the cart table is
+    the only copy, so items removed or ordered since don't come back.
+    """
+    claimed = (User.query
+                   .filter(User.id == user_id, User.browser_cart_merged.is_(False))
+                   .update({'browser_cart_merged': True}, synchronize_session=False))
+    db.session.commit()
+    if not claimed:
+        return
+
+    known = {item.ingredient_id for item in cart_items(user_id)}
+    new_items = [item for item in data or [] if item['id'] not in known]
+    if new_items:
+        add_to_cart(user_id, new_items)
+
+
+def cart_items(user_id):
+    return CartItem.query.filter(CartItem.user_id == user_id).order_by(CartItem.id).all()
+
+
+def cart_json(items):
+    return {
+        'cart_items': [{
+            'id': item.ingredient_id,
+            'name': item.ingredient_name,
+            'image': image_proxy.url(item.ingredient_image, 'thumb'),
+            'count': item.count,
+            'price': cents_to_dollars(item.price_cents),
+            'total': cents_to_dollars(item.total_cents)
+        } for item in items],
+        'cart_total': cents_to_dollars(sum(item.total_cents for item in items))
     }
 
-    return jsonify(results)
 
+def add_to_cart(user_id, data):
+    """Add or top up cart items, looking up names and images only for ingredients that come without them"""
+    ingredients = lookup_ingredients([item['id'] for item in data if not item.get('name')])
 
-@app.route('/user/cart/submit', methods=['POST'])
-def submit_user_cart():
-    user = User.query.get(g.user.id)
+    for attempt in range(2):
+        existing = {item.ingredient_id: item for item in
+                    CartItem.query.filter(CartItem.user_id == user_id,
+                                          CartItem.ingredient_id.in_([item['id'] for item in data])).all()}
 
-    if len(user.orders) == 0:
-        order_num = 1
-    else:
-        order_num = user.orders[0].order_id + 1
+        for item in data:
+            cart_item = existing.get(item['id'])
+            if cart_item is None:
+                name, image = ingredients.get(item['id'], (item.get('name'), ingredient_image_url(item.get('image'))))
+                cart_item = existing[item['id']] = CartItem(user_id=user_id, ingredient_id=item['id'], ingredient_name=name,
+                                                            ingredient_image=image, count=0, price_cents=to_cents(item['price']))
+                db.session.add(cart_item)
+            cart_item.set_count(cart_item.count + int(item['count']))
+
+        try:
+            db.session.commit()
+            return
+        except IntegrityError:
+            """Another request added one of these first, so top up its row instead"""
+            db.session.rollback()
+            if attempt:
+                raise
 
-    data = request.json.get('order')
 
-    for item in data:
-        db.session.add(Order(order_id=order_num, user_id=user.id, ingredient_id=item['id'], ingredient_count=item['count'], ingredient_price=item['price']))
-        db.session.commit()
+def to_cents(price):
+    return int((decimal.Decimal(str(price)) * 100).quantize(decimal.Decimal('1')))
 
 
-    flash('Order submitted successfully!', 'success')
-    return redirect('/user/cart/previous')
+def cents_to_dollars(cents):
+    return decimal.Decimal(cents).scaleb(-2)
 
 
-@app.route('/user/cart/previous', methods=['GET', 'POST'])
-def user_order_history():
-    user = User.query.get(g.user.id)
-    num_of_orders = user.orders[0].order_id
-    orders = []
-    
-    for order in user.orders:
-        res = requests.get(f'https://api.spoonacular.com/food/ingredients/{order.ingredient_id}/information',
-           params={
-            'apiKey': spoonacular_key,
-           }).text
-    
-        ingredient_info = json.loads(res)
-    
-        info = {
-            'order_id': order.order_id,
-            'name': ingredient_info['originalName'],
-            'image': f"https://spoonacular.com/cdn/ingredients_100x100/{ ingredient_info['image'] }",
-            'count': order.ingredient_count,
-            'price': order.ingredient_price,
-            'total': decimal.Decimal(float(order.ingredient_count) * float(order.ingredient_price)).quantize(decimal.Decimal('0.00'))
-        }
+@main.route('/user/cart/submit', methods=['POST'])
+def submit_user_cart():
+    """Save the cart as one order and empty it, all in the same transaction"""
+    merge_browser_cart(g.user.id, request.json.get('order') if request.is_json else None)
+
+    """The rows are deleted before the order is written. A concurrent submit that got to
+    them first leaves fewer to delete, and this one is dropped instead of ordering them twice."""
+    items = CartItem.query.filter(CartItem.user_id == g.user.id).order_by(CartItem.id).with_for_update().all()
+    consumed = CartItem.query.filter(CartItem.id.in_([item.id for item in items])).delete(synchronize_session=False)
+    if consumed != len(items):
+        db.session.rollback()
+        items = []
+
+    if len(items) > 0:
+        order = Order(user_id=g.user.id)
+        db.session.add(order)
+        db.session.flush()
+
+        line_items = []
+        for item in items:
+            line_items.append({
+                'order_id': order.id,
+                'ingredient_id': item.ingredient_id,
+                'ingredient_count': item.count,
+                'ingredient_price': item.price_cents / 100,
+                'ingredient_name': item.ingredient_name,
+                'ingredient_image': item.ingredient_image
+            })
+
+        db.session.execute(OrderItem.__table__.insert(), line_items)
+        db.session.commit()
 
-        orders.append(info)
+    flash('Order submitted successfully!', 'success')
+    return redirect('/user/cart/previous')
 
-    """Create list of items in each order"""
-    order_dict = {}
-    for i in reversed(range(1, num_of_orders+1)): 
-        order_dict[i] = {'items': [], 'total': 0}
-        for order in orders:
-            if order['order_id'] == i:
-                order_dict[i]['items'].append(order)
 
-    """Calculate the total price of each order"""
-    order_num = num_of_orders
-    for order in order_dict:
-        order_total = 0
-        for item in order_dict[order]['items']:
-            if item['order_id'] == order_num:
+@main.route('/user/cart/previous', methods=['GET', 'POST'])
+def user_order_history():
+    """Show the user's previous orders, newest first, one page at a time"""
+    user = get_current_user()
+    per_page = current_app.config['ORDERS_PER_PAGE']
+    before = request.args.get('before', type=int)
+
+    """Order totals and item counts for this page are computed by the database"""
+    totals = (db.session.query(OrderItem.order_id,
+                               func.sum(OrderItem.ingredient_count * OrderItem.ingredient_price).label('total'),
+                               func.sum(OrderItem.ingredient_count).label('item_count'))
+                        .join(Order)
+                        .filter(Order.user_id == user.id))
+
+    if before:
+        totals = totals.filter(OrderItem.order_id < before)
+
+    page = totals.group_by(OrderItem.order_id).order_by(OrderItem.order_id.desc()).limit(per_page + 1).all()
+    next_page = page[per_page - 1].order_id if len(page) > per_page else None
+    page = page[:per_page]
+
+    """Orders are read like a dict keyed by order id, each sent as soon as its line items are ready"""
+    orders = StreamedOrders([order.order_id for order in page], order_blocks(page))
+    return stream_page('user/previous_orders.html', user=user, orders=orders, next_page=next_page)
+
+
+def order_blocks(page):
+    """Yield (order id, order) for a page of order totals, reading all their line items in one query"""
+    line_items = (OrderItem.query
+                           .filter(OrderItem.order_id.in_([order.order_id for order in page]))
+                           .order_by(OrderItem.order_id.desc(), OrderItem.id)
+                           .all())
+
+    """Rows saved before ingredient info was stored on orders are filled in by a background job"""
+    if queue_order_backfill([item.id for item in line_items if item.ingredient_name is None and not item.backfill_queued]):
+        db.session.commit()
 
-                order_total = order_total + (item['price'] * item['count'])
-        
-        order_num = order_num - 1
-        order_dict[order]['total'] = decimal.Decimal(order_total).quantize(decimal.Decimal('0.00'))
-                    
-    return render_template('user/previous_orders.html', user=user, orders=order_dict)
+    items_by_order = {}
+    for item in line_items:
+        items_by_order.setdefault(item.order_id, []).append(item)
+
+    for order in page:
+        items = items_by_order.get(order.order_id, [])
+
+        yield order.order_id, {
+            'items': [{
+                'order_id': item.order_id,
+                'name': item.ingredient_name,
+                'image': image_proxy.url(item.ingredient_image, 'thumb'),
+                'count': item.ingredient_count,
+                'price': item.ingredient_price,
+                'total': decimal.Decimal(float(item.ingredient_count) * float(item.ingredient_price)).quantize(decimal.Decimal('0.00'))
+            } for item in items],
+            'count': order.item_count,
+            'total': decimal.Decimal(order.total).quantize(decimal.Decimal('0.00'))
+        }
 
 
-@app.route('/user/cart')
+@main.route('/user/cart')
 def user_cart():
-    user = User.query.get(g.user.id)
+    user = get_current_user()
 
     return render_template('user/cart.html', user=user)
 
 # Recipes ********************************************************************************
 
-@app.route('/recipes/favorite', methods=['GET', 'POST'])
+@main.route('/recipes/favorite', methods=['GET', 'POST'])
 def recipe_fav():
     """Get recipe ID from js when favorite star is pressed and either add or remove from favorites"""
     recipe = int(request.json['recipeID'])
-    user = User.query.get(g.user.id)
-    favorites = [recipe.recipe_id for recipe in user.favorites]
 
-    if (recipe in favorites):
-        db.session.delete(Favorite.query.filter(Favorite.recipe_id == recipe, Favorite.user_id == g.user.id).first())
-        db.session.commit()
-    else:
+    removed = Favorite.query.filter(Favorite.user_id == g.user.id, Favorite.recipe_id == recipe).delete()
+    if not removed:
         db.session.add(Favorite(user_id=g.user.id, recipe_id=recipe))
+        job_queue.enqueue('warm_recipes', recipe_ids=[recipe])
+    user_recipe_ids.changed(g.user)
+
+    try:
         db.session.commit()
+    except IntegrityError:
+        """Another request favorited the same recipe first"""
+        db.session.rollback()
 
     return jsonify(recipe)
     
 
-@app.route('/recipes/more', methods=['GET', 'POST'])
+@main.route('/recipes/more', methods=['GET', 'POST'])
 def recipes_more():
-    res = requests.get('https://api.spoonacular.com/recipes/random',
-                           params={
-                            'apiKey': spoonacular_key,
-                            'number': 10
-                           }).text
-
-    recipes_data = json.loads(res)
-    recipes = recipes_data['recipes']
+    recipes = random_recipes.take(number=10)
+    index_recipes(recipes)
 
-    favorites = []
+    favorites = frozenset()
 
     if g.user:
-        user = User.query.get(g.user.id)
-        favorites = [recipe.recipe_id for recipe in user.favorites]
+        favorites = user_recipe_ids.favorites(g.user)
+
+    ratings = recipe_ratings([recipe['id'] for recipe in recipes])
 
     modified_recipes = []
 
     for recipe in recipes:
-        fixed_recipe = {
-            'id': recipe['id'],
-            'title': recipe['title'],
-            'sourceUrl': recipe['sourceUrl'],
-            'image': recipe.get('image', '/static/images/def_img.png'),
-            'summary': recipe['summary'],
-            'tags': {
-                'Vegetarian': recipe['vegetarian'],
-                'Vegan': recipe['vegan'],
-                'Gluten Free': recipe['glutenFree'],
-                'Dairy Free': recipe['dairyFree'],
-                'Very Healthy': recipe['veryHealthy'],
-                'Cheap': recipe['cheap'],
-                'Very Popular': recipe['veryPopular'],
-                'Sustainable': recipe['sustainable']
-            }
-        }
+        fixed_recipe = {**recipe_card(recipe), 'rating': ratings.get(recipe['id'])}
 
         if g.user:
             fixed_recipe['favorite'] = recipe['id'] in favorites
@@ -397,80 +720,156 @@ def recipes_more():
     return jsonify(modified_recipes)
 
 
-@app.route('/recipes/browse', methods=['GET', 'POST'])
+@main.route('/recipes/browse', methods=['GET', 'POST'])
 def recipes_browse():
     form = FilterRecipesForm()
 
     if form.validate_on_submit:
-        res = requests.get('https://api.spoonacular.com/recipes/random',
-                       params={
-                        'apiKey': spoonacular_key,
-                        'number': 10,
-                        'tags': form.filters.data
-                       }).text
-    
-        recipes_data = json.loads(res)
+        recipes = random_recipes.take(form.filters.data, number=10)
 
     else:
-        res = requests.get('https://api.spoonacular.com/recipes/random',
-                               params={
-                                'apiKey': spoonacular_key,
-                                'number': 10
-                               }).text
+        recipes = random_recipes.take(number=10)
 
-        recipes_data = json.loads(res)
-    
-    recipes = recipes_data['recipes']
+    index_recipes(recipes)
+
+    ratings = recipe_ratings([recipe['id'] for recipe in recipes])
 
     modified_recipes = []
 
     for recipe in recipes:
-        fixed_recipe = {
-            'id': recipe['id'],
-            'title': recipe['title'],
-            'sourceUrl': recipe['sourceUrl'],
-            'image': recipe.get('image', '/static/images/def_img.png'),
-            'summary': recipe['summary'],
-            'tags': {
-                'Vegetarian': recipe['vegetarian'],
-                'Vegan': recipe['vegan'],
-                'Gluten Free': recipe['glutenFree'],
-                'Dairy Free': recipe['dairyFree'],
-                'Very Healthy': recipe['veryHealthy'],
-                'Cheap': recipe['cheap'],
-                'Very Popular': recipe['veryPopular'],
-                'Sustainable': recipe['sustainable']
-            }
-        }
-        
-        modified_recipes.append(fixed_recipe)
+        modified_recipes.append({**recipe_card(recipe), 'rating': ratings.get(recipe['id'])})
 
     if g.user:
-        user = User.query.get(g.user.id)
-        favorites = [recipe.recipe_id for recipe in user.favorites]
+        user = get_current_user()
+        favorites = user_recipe_ids.favorites(user)
 
-        return render_template('recipes/browse.html', recipes=modified_recipes, favorites=favorites, form=form)
+        etag = page_cache.etag('browse', modified_recipes, [recipe['id'] in favorites for recipe in recipes], user_etag(user))
+        return page_cache.conditional(etag, lambda: render_template('recipes/browse.html', recipes=modified_recipes, favorites=favorites, form=form))
     
     else:
-        return render_template('recipes/browse.html', recipes=modified_recipes, form=form)
+        etag = page_cache.etag('browse', modified_recipes)
+        return page_cache.conditional(etag, lambda: render_template('recipes/browse.html', recipes=modified_recipes, form=form))
+
+
+def recipe_card(recipe):
+    """The part of a recipe shown on browse pages, built once per recipe"""
+    return page_cache.fragment('card', recipe['id'], None, lambda: {
+        'id': recipe['id'],
+        'title': recipe['title'],
+        'sourceUrl': recipe['sourceUrl'],
+        'image': image_proxy.url(recipe.get('image', '/static/images/def_img.png'), 'card'),
+        'summary': recipe['summary'],
+        'tags': {
+            'Vegetarian': recipe['vegetarian'],
+            'Vegan': recipe['vegan'],
+            'Gluten Free': recipe['glutenFree'],
+            'Dairy Free': recipe['dairyFree'],
+            'Very Healthy': recipe['veryHealthy'],
+            'Cheap': recipe['cheap'],
+            'Very Popular': recipe['veryPopular'],
+            'Sustainable': recipe['sustainable']
+        }
+    })
+
+
+def recipe_ratings(recipe_ids):
+    """{recipe id: rating} for every recipe with reviews, in one query"""
+    summaries = RecipeRatingSummary.query.filter(RecipeRatingSummary.recipe_id.in_(recipe_ids)).all()
+    return {summary.recipe_id: rating_info(summary) for summary in summaries}
+
 
+def rating_info(summary):
+    if summary is None or summary.review_count == 0:
+        return None
 
-@app.route('/recipes/<int:recipe_id>')
+    return {
+        'count': summary.review_count,
+        'average': summary.average,
+        'histogram': summary.histogram
+    }
+
+
+def user_etag(user):
+    """What the page header shows about the logged in user, and which favorites and reviews they have"""
+    return [user.id, user.username, user.profile_pic, user.recipe_ids_version]
+
+
+@main.route('/recipes/<int:recipe_id>')
 def recipe_details(recipe_id):
     """Get info for recipe to display on page"""
-    res = requests.get(f'https://api.spoonacular.com/recipes/{ recipe_id }/information',
-                           params={
-                            'apiKey': spoonacular_key,
-                            'id': recipe_id
-                           }).text
 
-    recipe_info = json.loads(res)
+    """Recipe fragments are versioned by when the recipe was fetched, so a refetch or invalidate() replaces them.
+    Nutrition is fetched in the background while the recipe and reviews load, and only cached once the recipe is."""
+    cached_at = recipe_cache.fetched_at(recipe_id)
+    if cached_at is None:
+        nutrition_future = spoonacular.submit(fetch_nutrition, recipe_id)
+    else:
+        nutrition_future = spoonacular.submit(page_cache.fragment, 'nutrition', recipe_id, cached_at, lambda: fetch_nutrition(recipe_id))
+
+    recipe_info = get_recipe_info(recipe_id)
+    fetched_at = cached_at or recipe_cache.fetched_at(recipe_id)
+    modified_info = page_cache.fragment('recipe', recipe_id, fetched_at, lambda: recipe_body(recipe_info))
+
+    """The rating summary changes with every review, so it versions the review list"""
+    summary = db.session.get(RecipeRatingSummary, recipe_id)
+    rating = rating_info(summary)
+    review_version = (summary.review_count, summary.last_review_id) if summary else (0, None)
+
+    before = request.args.get('reviews_before', type=int)
+    reviews, next_reviews = page_cache.fragment('reviews', (recipe_id, before), review_version, lambda: review_page(recipe_id, before))
+
+    nutrition = wait_for_nutrition(nutrition_future)
+    if cached_at is None and nutrition is not None:
+        page_cache.fragment('nutrition', recipe_id, fetched_at, lambda: nutrition)
+
+    if g.user:
+        user = get_current_user()
+        favorites = user_recipe_ids.favorites(user)
+
+        user_review = None
+        if recipe_id in user_recipe_ids.reviewed(user):
+            user_review = Review.query.filter(Review.user_id == user.id, Review.recipe_id == recipe_id).first()
+
+        etag = page_cache.etag('recipe', modified_info, nutrition, review_version, before, recipe_id in favorites, user_review and user_review.id, user_etag(user))
+        return page_cache.conditional(etag, lambda: render_template('recipes/details.html', recipe=modified_info, favorites=favorites, nutrition=nutrition, reviews=reviews, next_reviews=next_reviews, rating=rating, user_review=user_review))
+    
+    else:    
+        etag = page_cache.etag('recipe', modified_info, nutrition, review_version, before)
+        return page_cache.conditional(etag, lambda: render_template('recipes/details.html', recipe=modified_info, nutrition=nutrition, reviews=reviews, next_reviews=next_reviews, rating=rating))
+
+
+def review_page(recipe_id, before):
+    """One page of a recipe's reviews, newest first, and the ?reviews_before= value for the next page"""
+    per_page = current_app.config['REVIEWS_PER_PAGE']
+
+    reviews = (db.session.query(Review.id,
+                                User.id,
+                                User.username,
+                                User.profile_pic,
+                                Review.recipe_id,
+                                Review.rating,
+                                Review.comment)
+                         .join(User, User.id == Review.user_id)
+                         .filter(Review.recipe_id == recipe_id))
+
+    if before:
+        reviews = reviews.filter(Review.id < before)
+
+    page = reviews.order_by(Review.id.desc()).limit(per_page + 1).all()
+    next_reviews = page[per_page - 1][0] if len(page) > per_page else None
+
+    """Profile pictures are whatever URL the user gave, so they're served through the image proxy too"""
+    return [(user_id, username, image_proxy.url(profile_pic, 'avatar'), *rest)
+            for review_id, user_id, username, profile_pic, *rest in page[:per_page]], next_reviews
+
 
-    modified_info = {
+def recipe_body(recipe_info):
+    """The part of the recipe page that's the same for everyone"""
+    return {
         'id': recipe_info['id'],
         'title': recipe_info['title'],
         'sourceUrl': recipe_info['sourceUrl'],
-        'image': recipe_info.get('image', '/static/images/def_img.png'),
+        'image': image_proxy.url(recipe_info.get('image', '/static/images/def_img.png'), 'hero'),
         'summary': recipe_info['summary'],
         'servings': recipe_info['servings'],
         'readyInMinutes': recipe_info['readyInMinutes'],
@@ -488,13 +887,10 @@ def recipe_details(recipe_id):
         }
     }
 
-    res = requests.get(f'https://api.spoonacular.com/recipes/{ recipe_id }/nutritionWidget.json',
-                           params={
-                            'apiKey': spoonacular_key,
-                            'id': recipe_id
-                           }).text
 
-    nutrition_data = json.loads(res)
+def fetch_nutrition(recipe_id):
+    """Get the nutrition widget for a recipe and pick out calories and nutrients"""
+    nutrition_data = spoonacular.get(f'/recipes/{ recipe_id }/nutritionWidget.json')
 
     calories = int(''.join(char for char in nutrition_data['calories'] if char.isdigit()))
 
@@ -502,54 +898,43 @@ def recipe_details(recipe_id):
     modified_bad = [{**nutrient, 'rating': 'bad'} for nutrient in nutrition_data['bad']] 
     modified_nutrients = [nutrient for nutrient in (modified_good + modified_bad)]
 
-    modified_data = {
+    return {
         'calories': calories,
         'nutrients' : modified_nutrients
     }
 
-    reviews = (db.session.query(User.id,
-                                User.username,
-                                User.profile_pic,
-                                Review.recipe_id,
-                                Review.rating,
-                                Review.comment)
-                            .join(Review).filter(Review.recipe_id == recipe_id).all())
-
-    if g.user:
-        user = User.query.get(g.user.id)
-        favorites = [recipe.recipe_id for recipe in user.favorites]
 
-        user_review = Review.query.filter(Review.user_id == user.id, Review.recipe_id == recipe_id).first()
+def wait_for_nutrition(nutrition_future):
+    """Give nutrition until NUTRITION_TIMEOUT to finish, rendering the page without it if it's too slow"""
+    try:
+        return nutrition_future.result(timeout=current_app.config['NUTRITION_TIMEOUT'])
+    except (FutureTimeoutError, RequestException, QuotaExceeded, KeyError, ValueError):
+        return None
 
-        return render_template('recipes/details.html', recipe=modified_info, favorites=favorites, nutrition=modified_data, reviews=reviews, user_review=user_review)
-    
-    else:    
-        
-        return render_template('recipes/details.html', recipe=modified_info, nutrition=modified_data, reviews=reviews)
 
-
-@app.route('/recipes/resourceful/add', methods=['GET', 'POST'])
+@main.route('/recipes/resourceful/add', methods=['GET', 'POST'])
 def add_recipes_resourceful():
     """Get recipes using ingredients entered into the form"""
     ingredientsList = request.json.get('ingredients')
     ingredients = ', '.join(str(ingredient) for ingredient in ingredientsList)
 
-    res = requests.get('https://api.spoonacular.com/recipes/findByIngredients',
-                   params={
-                    'apiKey': spoonacular_key,
-                    'ingredients': ingredients,
-                    'number': 10,
-                    'limitLicense': True,
-                    'ranking': 2,
-                    'ignorePantry': True
-                   }).text
+    favorites = None
+    if g.user:
+        favorites = user_recipe_ids.favorites(g.user)
 
-    recipe_info = json.loads(res)
+    """Recipes we've already fetched are ranked locally, favorites are marked in the same pass"""
+    recipe_info = ingredient_index.find([str(ingredient) for ingredient in ingredientsList], number=10, favorites=favorites)
+    if len(recipe_info) >= current_app.config['RESOURCEFUL_MIN_RESULTS']:
+        return jsonify(recipe_info)
 
-    if g.user:
-        user = User.query.get(g.user.id)
-        favorites = [recipe.recipe_id for recipe in user.favorites]
+    recipe_info = spoonacular.get('/recipes/findByIngredients',
+                                  ingredients=ingredients,
+                                  number=10,
+                                  limitLicense=True,
+                                  ranking=2,
+                                  ignorePantry=True)
 
+    if g.user:
         for recipe in recipe_info:
             if recipe['id'] in favorites:
                 recipe['favorite'] = True
@@ -559,34 +944,44 @@ def add_recipes_resourceful():
     return jsonify(recipe_info)
 
 
-@app.route('/recipes/resourceful', methods=['GET', 'POST'])
+@main.route('/recipes/resourceful', methods=['GET', 'POST'])
 def recipes_resourceful():
     """Get recipes using ingredients entered into the form"""
 
     return render_template('recipes/resourceful.html')
 
 
-@app.route('/recipes/search', methods=['GET','POST'])
+@main.route('/recipes/search', methods=['GET','POST'])
 def recipe_search():
     """Search for recipe by key words"""
     recipe = request.args.get('search')
 
-    res = requests.get('https://api.spoonacular.com/recipes/complexSearch',
-                       params={
-                        'apiKey': spoonacular_key,
-                        'query': recipe
-                       }).text
-    
-    recipe_info = json.loads(res)
-    results = recipe_info['results']
+    results = page_cache.fragment('search', (recipe or '').strip().lower(), None, lambda: search_recipes(recipe))
+
+    if g.user:
+        etag = page_cache.etag('search', results, user_etag(get_current_user()))
+    else:
+        etag = page_cache.etag('search', results)
+
+    return page_cache.conditional(etag, lambda: render_template('recipes/search.html', results=results))
+
+
+def search_recipes(recipe):
+    """Answer from recipes we've already fetched, only searching Spoonacular if too few match"""
+    results = recipe_index.search(recipe, limit=current_app.config['SEARCH_RESULTS'])
+
+    if len(results) < current_app.config['SEARCH_MIN_RESULTS']:
+        recipe_info = spoonacular.get('/recipes/complexSearch', query=recipe, number=current_app.config['SEARCH_RESULTS'])
+        results = recipe_info['results']
+        recipe_index.add_many(results)
 
-    return render_template('recipes/search.html', results=results)
+    return results
 
 
 
 # Ingredients ********************************************************************************
 
-@app.route('/ingredients/substitute', methods=['GET','POST'])
+@main.route('/ingredients/substitute', methods=['GET','POST'])
 def ingredient_subs():
     """Find substitutes for specified ingredient"""
     form = IngredientSubsForm()
@@ -595,13 +990,11 @@ def ingredient_subs():
     if form.validate_on_submit():
         ingredient = form.ingredient.data
 
-        res = requests.get('https://api.spoonacular.com/food/ingredients/substitutes',
-                           params={
-                            'apiKey': spoonacular_key,
-                            'ingredientName': ingredient
-                           }).text
-
-        recipe_info = json.loads(res)
+        try:
+            recipe_info = ingredient_lookup.substitutes(ingredient)
+        except RequestException:
+            """Shown the same as no substitutes found, which is how plan errors looked before they raised"""
+            recipe_info = {'status': 'failure'}
 
         if recipe_info['status'] == 'success':
             modified_info['status'] = recipe_info['status']
@@ -613,7 +1006,7 @@ def ingredient_subs():
     return render_template('ingredients/substitutes.html', form=form, results=modified_info)
 
 
-@app.route('/ingredients/order', methods=['GET','POST'])
+@main.route('/ingredients/order', methods=['GET','POST'])
 def ingredient_order():
     """Create order and submit to instacart"""
     form = ShopIngredientsForm()
@@ -621,14 +1014,8 @@ def ingredient_order():
     if form.validate_on_submit():
         ingredient = form.ingredient.data
 
-        res = requests.get('https://api.spoonacular.com/food/ingredients/search',
-                   params={
-                    'apiKey': spoonacular_key,
-                    'query': ingredient
-                   }).text
-
-        ingredient_info = json.loads(res)
-        results = ingredient_info['results']
+        ingredient_info = ingredient_lookup.search(ingredient)
+        results = [dict(item) for item in ingredient_info['results']]
 
 
         """Simulate a price"""
@@ -638,23 +1025,93 @@ def ingredient_order():
     else:
         return render_template('ingredients/order.html', form=form)
 
+
+@main.route('/ingredients/typeahead')
+def ingredient_typeahead():
+    """Suggest known ingredient names starting with what's been typed so far"""
+    prefix = request.args.get('q', '')
+
+    return jsonify(ingredient_lookup.names.complete(prefix, limit=10))
+
 # Review ********************************************************************************
 
-@app.route('/review/<int:recipe_id>/submit')
+@main.route('/review/<int:recipe_id>/submit')
 def submit_review(recipe_id):
     """Process recipe review submitted by user"""
-    user = User.query.get(g.user.id)
-    reviews = [review.recipe_id for review in user.reviews]
+    rating = request.args.get('rating', type=int)
+    comment = request.args.get('comment')
 
-    if (recipe_id in reviews):
-        flash("You've already left a review for this recipe", 'danger')
-        return redirect(f'/recipe/{ recipe_id }')
-    else:
-        rating = request.args.get('rating')
-        comment = request.args.get('comment')
-        db.session.add(Review(user_id=g.user.id, recipe_id=recipe_id, rating=rating, comment=comment))
-        db.session.commit()
+    if rating not in range(1, 6):
+        flash("Ratings are from 1 to 5 stars", 'danger')
+        return redirect(f'/recipes/{ recipe_id }')
 
-        flash('Review submitted successfully!', 'success')
+    ensure_rating_summary(recipe_id)
+
+    """The review and the recipe's rating summary are saved in the same transaction"""
+    try:
+        review = Review(user_id=g.user.id, recipe_id=recipe_id, rating=rating, comment=comment)
+        db.session.add(review)
+        db.session.flush()
+
+        stars = getattr(RecipeRatingSummary, f'stars_{ rating }')
+        (RecipeRatingSummary.query
+                            .filter(RecipeRatingSummary.recipe_id == recipe_id)
+                            .update({
+                                'review_count': RecipeRatingSummary.review_count + 1,
+                                'rating_sum': RecipeRatingSummary.rating_sum + rating,
+                                stars.key: stars + 1,
+                                'last_review_id': case((RecipeRatingSummary.last_review_id > review.id, RecipeRatingSummary.last_review_id),
+                                                       else_=review.id)
+                            }, synchronize_session=False))
+        user_recipe_ids.changed(g.user)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash("You've already left a review for this recipe", 'danger')
         return redirect(f'/recipes/{ recipe_id }')
 
+    flash('Review submitted successfully!', 'success')
+    return redirect(f'/recipes/{ recipe_id }')
+
+
+def ensure_rating_summary(recipe_id):
+    """Create the recipe's summary row before its first review, so saving a review only ever updates it"""
+    if db.session.get(RecipeRatingSummary, recipe_id) is None:
+        db.session.add(RecipeRatingSummary(recipe_id=recipe_id))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+# Jobs ********************************************************************************
+
+@job_queue.task('warm_recipes', concurrency=2)
+def warm_recipes(recipe_ids):
+    """Make sure recipes are in the recipe cache, using the background share of the quota"""
+    recipe_cache.get_many(recipe_ids, lambda ids: spoonacular.recipe_information_bulk(ids, priority='background'))
+
+
+def queue_order_backfill(order_item_ids):
+    """Queue a backfill for order items, unless another request already marked them as queued.
+
+    The conditional UPDATE is the dedupe: a request that loses the race to mark the
+    items updates no rows and doesn't queue a job. Returns True if a job was queued.
+    """
+    if not order_item_ids:
+        return False
+
+    marked = (OrderItem.query
+                       .filter(OrderItem.id.in_(order_item_ids), OrderItem.backfill_queued.is_(False))
+                       .update({'backfill_queued': True}, synchronize_session=False))
+    if marked:
+        job_queue.enqueue('backfill_order_ingredients', order_item_ids=order_item_ids)
+    return bool(marked)
+
+
+@job_queue.task('backfill_order_ingredients')
+def backfill_order_ingredients(order_item_ids):
+    """Store ingredient names and images on order items saved without them"""
+    items = OrderItem.query.filter(OrderItem.id.in_(order_item_ids)).all()
+    if snapshot_ingredients(items):
+        db.session.commit()
+
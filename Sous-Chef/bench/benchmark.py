@@ -0,0 +1,151 @@
+"""Route-level benchmark for Sous-Chef, run against the offline Spoonacular stand-in.
+
+Starts bench/fake_spoonacular.py in a background thread, points the app at it and
+at a throwaway database, seeds a user with favorites, reviews and orders, then
+drives each route from several threads and reports latency percentiles,
+throughput and upstream calls per request. No real API quota is used.
+
+    python bench/benchmark.py --concurrency 8 --requests 200 --latency 0.15
+"""
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_spoonacular import create_app as create_fake_spoonacular
+
+
+ROUTES = ['/', '/recipes/browse', '/recipes/<id>', '/user/<id>', '/user/cart/load', '/user/cart/previous']
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def start_fake_spoonacular(latency):
+    server = make_server('127.0.0.1', 0, create_fake_spoonacular(latency), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{ server.server_port }'
+
+
+def upstream_calls(base_url):
+    with urllib.request.urlopen(f'{ base_url }/calls') as res:
+        counts = json.load(res)
+    return sum(count for rule, count in counts.items() if rule != '/calls')
+
+
+def seed(favorites, reviews, orders, items_per_order):
+    """Create a user with favorites, reviews and order history, and return its id"""
+    from models import db, User, Favorite, Review, Order, OrderItem
+
+    user = User.register(first_name='Bench', last_name='User', username=f'bench{ int(time.time()) }'[:20],
+                         email=f'bench{ time.time_ns() }@example.com', profile_pic=None, password='benchmark')
+    db.session.commit()
+
+    recipe_ids = random.sample(range(1, 100000), favorites + reviews)
+    for recipe_id in recipe_ids[:favorites]:
+        db.session.add(Favorite(user_id=user.id, recipe_id=recipe_id))
+    for recipe_id in recipe_ids[favorites:]:
+        db.session.add(Review(user_id=user.id, recipe_id=recipe_id, rating=random.randint(1, 5), comment='Benchmark review'))
+
+    for _ in range(orders):
+        order = Order(user_id=user.id)
+        db.session.add(order)
+        db.session.flush()
+        for ingredient_id in random.sample(range(1000, 1024), items_per_order):
+            db.session.add(OrderItem(order_id=order.id, ingredient_id=ingredient_id, ingredient_count=2, ingredient_price=3.5))
+
+    db.session.commit()
+    return user.id
+
+
+def make_request(client, route, user_id):
+    if route == '/recipes/<id>':
+        return client.get(f'/recipes/{ random.randint(1, 500) }')
+    if route == '/user/<id>':
+        return client.get(f'/user/{ user_id }')
+    if route == '/user/cart/load':
+        cart = [{'id': 1000 + i, 'count': 1 + i % 3, 'price': 2.5} for i in range(10)]
+        return client.post('/user/cart/load', json={'cart': cart})
+    return client.get(route)
+
+
+def run_route(app, route, user_id, total, concurrency, current_user):
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            with local.client.session_transaction() as session:
+                session[current_user] = user_id
+
+        started = time.perf_counter()
+        res = make_request(local.client, route, user_id)
+        res.get_data()
+        elapsed = time.perf_counter() - started
+        return elapsed, res.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, status in results)
+    errors = sum(1 for elapsed, status in results if status >= 400)
+    return latencies, wall, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per route first')
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds the stand-in adds to every upstream call')
+    parser.add_argument('--routes', nargs='*', default=ROUTES, choices=ROUTES)
+    parser.add_argument('--favorites', type=int, default=50)
+    parser.add_argument('--reviews', type=int, default=20)
+    parser.add_argument('--orders', type=int, default=30)
+    parser.add_argument('--database', help='database url, defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    spoonacular_url = start_fake_spoonacular(args.latency)
+    os.environ['SPOONACULAR_URL'] = spoonacular_url
+    os.environ['SPOONACULAR_DAILY_POINTS'] = str(10 ** 9)
+    os.environ['DATABASE_URL'] = args.database or f'sqlite:///{ tempfile.mkdtemp() }/bench.db'
+
+    from app import create_app, current_user
+    from migrations import run_migrations
+    app = create_app({'WTF_CSRF_ENABLED': False})
+
+    with app.app_context():
+        run_migrations()
+        user_id = seed(args.favorites, args.reviews, args.orders, items_per_order=8)
+
+    print(f'{ "route":<22}{ "p50 ms":>9}{ "p95 ms":>9}{ "p99 ms":>9}{ "req/s":>9}{ "upstream/req":>14}{ "errors":>8}')
+    for route in args.routes:
+        run_route(app, route, user_id, args.warmup, args.concurrency, current_user)
+
+        calls_before = upstream_calls(spoonacular_url)
+        latencies, wall, errors = run_route(app, route, user_id, args.requests, args.concurrency, current_user)
+        calls = upstream_calls(spoonacular_url) - calls_before
+
+        print(f'{ route:<22}'
+              f'{ percentile(latencies, 50):>9.1f}{ percentile(latencies, 95):>9.1f}{ percentile(latencies, 99):>9.1f}'
+              f'{ args.requests / wall:>9.1f}{ calls / args.requests:>14.2f}{ errors:>8}')
+
+
+if __name__ == '__main__':
+    main()
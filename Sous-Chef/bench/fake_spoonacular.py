@@ -0,0 +1,158 @@
+"""Offline stand-in for the parts of the Spoonacular API that app.py uses.
+
+Responses are generated from the ids and queries in the request, so the same
+request always gets the same answer. Every response waits `latency` seconds
+first, to look like a real round trip.
+
+    python bench/fake_spoonacular.py --port 5050 --latency 0.15
+    SPOONACULAR_URL=http://127.0.0.1:5050 flask run
+"""
+from collections import Counter
+from threading import Lock
+from flask import Flask, request, jsonify
+import argparse
+import random
+import time
+
+
+INGREDIENTS = ['butter', 'eggs', 'flour', 'sugar', 'milk', 'salt', 'chicken breast', 'garlic', 'onion',
+               'tomatoes', 'olive oil', 'pasta', 'rice', 'cheddar cheese', 'spinach', 'lemon', 'basil',
+               'black pepper', 'carrots', 'potatoes', 'heavy cream', 'parmesan cheese', 'ground beef', 'bacon']
+DISHES = ['Pasta', 'Salad', 'Soup', 'Stir Fry', 'Casserole', 'Tacos', 'Curry', 'Bake', 'Risotto', 'Omelette']
+TAGS = ['vegetarian', 'vegan', 'glutenFree', 'dairyFree', 'veryHealthy', 'cheap', 'veryPopular', 'sustainable']
+
+
+def ingredient(ingredient_id):
+    """Ingredient ids start at 1000, so 1000 + i is INGREDIENTS[i] everywhere"""
+    name = INGREDIENTS[(ingredient_id - 1000) % len(INGREDIENTS)]
+    return {
+        'id': ingredient_id,
+        'name': name,
+        'nameClean': name,
+        'originalName': name,
+        'image': f"{ name.replace(' ', '-') }.jpg",
+        'amount': 1 + ingredient_id % 3,
+        'unit': 'cup',
+        'original': f'1 cup { name }',
+        'estimatedCost': {'value': 50 + ingredient_id % 400, 'unit': 'US Cents'}
+    }
+
+
+def recipe(recipe_id):
+    rng = random.Random(recipe_id)
+    ingredients = [ingredient(id) for id in rng.sample(range(1000, 1000 + len(INGREDIENTS)), 6)]
+    title = f"{ ingredients[0]['name'].title() } { rng.choice(DISHES) }"
+    info = {
+        'id': recipe_id,
+        'title': title,
+        'image': f'https://spoonacular.com/recipeImages/{ recipe_id }-556x370.jpg',
+        'imageType': 'jpg',
+        'sourceUrl': f'https://example.com/recipes/{ recipe_id }',
+        'summary': f'{ title } is a simple recipe with { len(ingredients) } ingredients.',
+        'servings': rng.randint(1, 8),
+        'readyInMinutes': rng.randint(10, 120),
+        'aggregateLikes': rng.randint(0, 500),
+        'cuisines': [rng.choice(['italian', 'mexican', 'indian', 'american'])],
+        'dishTypes': [rng.choice(['lunch', 'dinner', 'side dish'])],
+        'extendedIngredients': ingredients,
+        'analyzedInstructions': [{'name': '', 'steps': [{'number': n, 'step': f'Step { n }.'} for n in range(1, 5)]}]
+    }
+    for tag in TAGS:
+        info[tag] = rng.random() < 0.3
+    return info
+
+
+def create_app(latency=0.0):
+    app = Flask(__name__)
+    app.config['LATENCY'] = latency
+    calls = Counter()
+    lock = Lock()
+
+    @app.before_request
+    def wait():
+        with lock:
+            calls[request.url_rule.rule if request.url_rule else request.path] += 1
+        time.sleep(app.config['LATENCY'])
+
+    @app.route('/calls')
+    def call_counts():
+        with lock:
+            return jsonify(dict(calls))
+
+    @app.route('/recipes/<int:recipe_id>/information')
+    def recipe_information(recipe_id):
+        return jsonify(recipe(recipe_id))
+
+    @app.route('/recipes/informationBulk')
+    def recipe_information_bulk():
+        return jsonify([recipe(int(id)) for id in request.args['ids'].split(',')])
+
+    @app.route('/recipes/<int:recipe_id>/nutritionWidget.json')
+    def nutrition(recipe_id):
+        rng = random.Random(recipe_id)
+        return jsonify({
+            'calories': f'{ rng.randint(150, 900) }k',
+            'good': [{'title': 'Protein', 'amount': f'{ rng.randint(5, 60) }g', 'percentOfDailyNeeds': rng.randint(5, 90)}],
+            'bad': [{'title': 'Fat', 'amount': f'{ rng.randint(2, 50) }g', 'percentOfDailyNeeds': rng.randint(5, 90)}]
+        })
+
+    @app.route('/recipes/random')
+    def random_recipes():
+        number = request.args.get('number', 1, type=int)
+        start = random.randint(1, 1000000)
+        return jsonify({'recipes': [recipe(id) for id in range(start, start + number)]})
+
+    @app.route('/recipes/complexSearch')
+    def complex_search():
+        query = request.args.get('query', '')
+        number = request.args.get('number', 10, type=int)
+        start = sum(query.encode()) * 100
+        results = [{key: recipe(id)[key] for key in ('id', 'title', 'image', 'imageType')} for id in range(start, start + number)]
+        return jsonify({'results': results, 'offset': 0, 'number': number, 'totalResults': number})
+
+    @app.route('/recipes/findByIngredients')
+    def find_by_ingredients():
+        pantry = [name.strip() for name in request.args.get('ingredients', '').split(',') if name.strip()]
+        number = request.args.get('number', 10, type=int)
+        start = sum(','.join(pantry).encode()) * 100
+        results = []
+        for id in range(start, start + number):
+            info = recipe(id)
+            used = [item for item in info['extendedIngredients'] if item['name'] in pantry]
+            missed = [item for item in info['extendedIngredients'] if item['name'] not in pantry]
+            results.append({
+                'id': id, 'title': info['title'], 'image': info['image'], 'imageType': 'jpg', 'likes': info['aggregateLikes'],
+                'usedIngredientCount': len(used), 'missedIngredientCount': len(missed),
+                'usedIngredients': used, 'missedIngredients': missed, 'unusedIngredients': []
+            })
+        return jsonify(results)
+
+    @app.route('/food/ingredients/<int:ingredient_id>/information')
+    def ingredient_information(ingredient_id):
+        return jsonify(ingredient(ingredient_id))
+
+    @app.route('/food/ingredients/substitutes')
+    def substitutes():
+        name = request.args.get('ingredientName', '')
+        if name not in INGREDIENTS:
+            return jsonify({'status': 'failure', 'message': f'Could not find any substitutes for { name }.'})
+        return jsonify({'status': 'success', 'ingredient': name, 'substitutes': [f'1 cup = 1 cup { name } substitute'],
+                        'message': 'Found 1 substitutes for the ingredient.'})
+
+    @app.route('/food/ingredients/search')
+    def ingredient_search():
+        query = request.args.get('query', '').lower()
+        matches = [ingredient(1000 + i) for i, name in enumerate(INGREDIENTS) if query in name]
+        return jsonify({'results': [{key: item[key] for key in ('id', 'name', 'image')} for item in matches],
+                        'offset': 0, 'number': len(matches), 'totalResults': len(matches)})
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds added to every response')
+    args = parser.parse_args()
+
+    create_app(args.latency).run(port=args.port, threaded=True)
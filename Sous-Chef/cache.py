@@ -0,0 +1,379 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from sqlalchemy.exc import IntegrityError
+from models import db, CachedRecipe, Favorite, Review, User
+from quota import QuotaExceeded
+import json
+import time
+
+
+RECIPE_FIELDS = ['id', 'title', 'sourceUrl', 'summary', 'servings', 'readyInMinutes', 'analyzedInstructions',
+                 'extendedIngredients', 'vegetarian', 'vegan', 'glutenFree', 'dairyFree', 'veryHealthy', 'cheap',
+                 'veryPopular', 'sustainable']
+
+
+def is_recipe(recipe_info):
+    """True if recipe_info has everything the recipe pages read, and isn't an error body"""
+    return isinstance(recipe_info, dict) and all(field in recipe_info for field in RECIPE_FIELDS)
+
+
+def load_recipe(data):
+    """Decode a recipe_cache row, or None if it doesn't hold a recipe"""
+    try:
+        recipe_info = json.loads(data)
+    except (TypeError, ValueError):
+        return None
+    return recipe_info if is_recipe(recipe_info) else None
+
+
+class RecipeInfoCache:
+    """Two level cache for Spoonacular recipe information.
+
+    Recipes are kept in an in-memory LRU first and in the recipe_cache table second,
+    so a recipe only goes back to the API once both copies have expired. If the API
+    quota is used up, an expired copy from the table is served instead.
+    """
+
+    def __init__(self, max_size=512, ttl=60 * 60, db_ttl=60 * 60 * 24 * 7):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_ttl = db_ttl
+        self._entries = OrderedDict()
+        self._listeners = []
+        self._lock = Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Read cache sizes and TTLs (in seconds) from the app config"""
+        self.max_size = app.config.setdefault('RECIPE_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.setdefault('RECIPE_CACHE_TTL', self.ttl)
+        self.db_ttl = app.config.setdefault('RECIPE_CACHE_DB_TTL', self.db_ttl)
+
+    def on_store(self, callback):
+        """Call callback(list of recipe info) whenever newly fetched recipes are stored"""
+        self._listeners.append(callback)
+
+    def get(self, recipe_id, fetch):
+        """Return recipe info for recipe_id, calling fetch(recipe_id) only if no fresh copy is cached"""
+        recipe_id = int(recipe_id)
+
+        recipe_info = self._get_memory(recipe_id)
+        if recipe_info is not None:
+            return recipe_info
+
+        recipe_info = self._get_db(recipe_id)
+        if recipe_info is not None:
+            self._set_memory(recipe_id, recipe_info)
+            return recipe_info
+
+        with self._lock:
+            self.misses += 1
+
+        try:
+            recipe_info = fetch(recipe_id)
+        except QuotaExceeded:
+            recipe_info = self._get_db(recipe_id, stale_ok=True)
+            if recipe_info is None:
+                raise
+            return recipe_info
+
+        if not is_recipe(recipe_info):
+            raise ValueError(f'Spoonacular did not return a recipe for { recipe_id }')
+
+        self.set(recipe_id, recipe_info)
+        return recipe_info
+
+    def get_many(self, recipe_ids, fetch_many):
+        """Return {id: recipe info} for recipe_ids, calling fetch_many(missing_ids) once for everything not cached.
+
+        If the API quota is used up, recipes with no cached copy at all are left out.
+        """
+        recipe_ids = list(dict.fromkeys(int(id) for id in recipe_ids))
+        found = {}
+        missing = []
+
+        for recipe_id in recipe_ids:
+            recipe_info = self._get_memory(recipe_id)
+            if recipe_info is None:
+                missing.append(recipe_id)
+            else:
+                found[recipe_id] = recipe_info
+
+        if missing:
+            for recipe_id, recipe_info in self._get_db_many(missing).items():
+                self._set_memory(recipe_id, recipe_info)
+                found[recipe_id] = recipe_info
+            missing = [id for id in missing if id not in found]
+
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+
+            try:
+                fetched = {recipe_info['id']: recipe_info for recipe_info in fetch_many(missing) if is_recipe(recipe_info)}
+            except QuotaExceeded:
+                found.update(self._get_db_many(missing, stale_ok=True))
+                return found
+
+            self.set_many(fetched)
+            found.update(fetched)
+
+        return found
+
+    def set(self, recipe_id, recipe_info):
+        """Store recipe info in memory and in the recipe_cache table"""
+        self.set_many({recipe_id: recipe_info})
+
+    def set_many(self, recipes):
+        """Store a {id: recipe info} dict in memory and in the recipe_cache table, skipping anything that isn't a recipe"""
+        recipes = {int(id): recipe_info for id, recipe_info in recipes.items() if is_recipe(recipe_info)}
+        if not recipes:
+            return
+
+        for recipe_id, recipe_info in recipes.items():
+            self._set_memory(recipe_id, recipe_info)
+
+        existing = {cached.recipe_id: cached for cached in
+                    CachedRecipe.query.filter(CachedRecipe.recipe_id.in_(list(recipes))).all()}
+        now = datetime.utcnow()
+
+        for recipe_id, recipe_info in recipes.items():
+            cached = existing.get(recipe_id)
+            if cached is None:
+                cached = CachedRecipe(recipe_id=recipe_id)
+                db.session.add(cached)
+
+            cached.title = recipe_info.get('title')
+            cached.image = recipe_info.get('image')
+            cached.data = json.dumps(recipe_info)
+            cached.fetched_at = now
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            """Another request stored the same recipe first"""
+            db.session.rollback()
+
+        for callback in self._listeners:
+            callback(list(recipes.values()))
+
+    def invalidate(self, recipe_id=None):
+        """Drop one recipe from both cache levels, or everything if no id is given"""
+        with self._lock:
+            if recipe_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(recipe_id), None)
+
+        if recipe_id is None:
+            CachedRecipe.query.delete()
+        else:
+            CachedRecipe.query.filter(CachedRecipe.recipe_id == int(recipe_id)).delete()
+        db.session.commit()
+
+    def fetched_at(self, recipe_id):
+        """When the stored copy of recipe_id was fetched, or None if there isn't one"""
+        return db.session.query(CachedRecipe.fetched_at).filter(CachedRecipe.recipe_id == int(recipe_id)).scalar()
+
+    def purge_invalid(self):
+        """Delete recipe_cache rows that don't hold a recipe, returning how many there were"""
+        bad = [cached.recipe_id for cached in CachedRecipe.query.all() if load_recipe(cached.data) is None]
+
+        for start in range(0, len(bad), 500):
+            CachedRecipe.query.filter(CachedRecipe.recipe_id.in_(bad[start:start + 500])).delete(synchronize_session=False)
+        db.session.commit()
+
+        with self._lock:
+            for recipe_id in bad:
+                self._entries.pop(recipe_id, None)
+        return len(bad)
+
+    def stats(self):
+        """Hit/miss counters for the cache"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses
+            }
+
+    def _get_memory(self, recipe_id):
+        with self._lock:
+            entry = self._entries.get(recipe_id)
+            if entry is None:
+                return None
+
+            expires, recipe_info = entry
+            if expires < time.monotonic():
+                del self._entries[recipe_id]
+                return None
+
+            self._entries.move_to_end(recipe_id)
+            self.hits += 1
+            return recipe_info
+
+    def _set_memory(self, recipe_id, recipe_info):
+        with self._lock:
+            self._entries[recipe_id] = (time.monotonic() + self.ttl, recipe_info)
+            self._entries.move_to_end(recipe_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_db(self, recipe_id, stale_ok=False):
+        cached = db.session.get(CachedRecipe, recipe_id)
+        if cached is None:
+            return None
+
+        if not stale_ok and cached.fetched_at < datetime.utcnow() - timedelta(seconds=self.db_ttl):
+            return None
+
+        recipe_info = load_recipe(cached.data)
+        if recipe_info is not None:
+            with self._lock:
+                self.db_hits += 1
+        return recipe_info
+
+    def _get_db_many(self, recipe_ids, stale_ok=False):
+        query = CachedRecipe.query.filter(CachedRecipe.recipe_id.in_(recipe_ids))
+        if not stale_ok:
+            query = query.filter(CachedRecipe.fetched_at >= datetime.utcnow() - timedelta(seconds=self.db_ttl))
+        recipes = {cached.recipe_id: load_recipe(cached.data) for cached in query.all()}
+        recipes = {recipe_id: recipe_info for recipe_id, recipe_info in recipes.items() if recipe_info is not None}
+
+        with self._lock:
+            self.db_hits += len(recipes)
+        return recipes
+
+
+class LookupCache:
+    """Small in-memory LRU with a TTL, for memoizing API lookups.
+
+    Results that is_negative() flags are kept for negative_ttl instead, so a bad
+    lookup isn't repeated on every request but is retried sooner than a good one.
+    Expired values are served if the API quota is used up.
+    """
+
+    def __init__(self, max_size=1024, ttl=60 * 60 * 24, negative_ttl=60 * 10, is_negative=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative or (lambda value: False)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fetch):
+        """Return the cached value for key, calling fetch(key) on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        try:
+            value = fetch(key)
+        except QuotaExceeded:
+            if entry is None:
+                raise
+            return entry[1]
+
+        ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class UserRecipeIds:
+    """Per user sets of favorited and reviewed recipe ids.
+
+    Every change to a user's favorites or reviews bumps users.recipe_ids_version in
+    the same commit, and a cached copy is only used while its version matches the
+    user row loaded for the request. Changes made by other processes are seen on the
+    next request, and ttl only bounds how long idle users are kept.
+    """
+
+    def __init__(self, max_size=4096, ttl=60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.max_size = app.config.setdefault('USER_RECIPE_IDS_SIZE', self.max_size)
+        self.ttl = app.config.setdefault('USER_RECIPE_IDS_TTL', self.ttl)
+
+    def favorites(self, user):
+        return self._get(user)['favorites']
+
+    def reviewed(self, user):
+        return self._get(user)['reviewed']
+
+    def changed(self, user):
+        """Mark user's favorites or reviews as changed, saved with the caller's next commit"""
+        user.recipe_ids_version = User.recipe_ids_version + 1
+        self.invalidate(user.id)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, user):
+        user_id = user.id
+        version = user.recipe_ids_version
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] >= time.monotonic() and entry[1] == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        ids = {
+            'favorites': frozenset(id for (id,) in db.session.query(Favorite.recipe_id).filter(Favorite.user_id == user_id)),
+            'reviewed': frozenset(id for (id,) in db.session.query(Review.recipe_id).filter(Review.user_id == user_id))
+        }
+
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, version, ids)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return ids
+
+
+recipe_cache = RecipeInfoCache()
+user_recipe_ids = UserRecipeIds()
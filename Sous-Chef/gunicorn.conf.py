@@ -0,0 +1,23 @@
+# gunicorn --config gunicorn.conf.py
+#
+# The app is imported once in the master and forked into workers, so workers start
+# without re-importing anything and share the master's memory copy-on-write.
+# Run `flask migrate` before starting; creating the app doesn't touch the database.
+import gc
+import os
+
+wsgi_app = 'app:create_app()'
+preload_app = True
+bind = f"0.0.0.0:{ os.environ.get('PORT', '8000') }"
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+
+
+def pre_fork(server, worker):
+    """Keep the garbage collector from touching (and so copying) the preloaded objects"""
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Each worker opens its own database connections, HTTP session and threads"""
+    from app import reset_after_fork
+    reset_after_fork(server.app.wsgi())
@@ -0,0 +1,234 @@
+from io import BytesIO
+from threading import Lock
+from urllib.parse import urljoin, urlparse
+from flask import request, redirect, abort, send_file, url_for
+from PIL import Image, ImageOps
+from quota import SingleFlight
+import hashlib
+import hmac
+import ipaddress
+import certifi
+import os
+import socket
+import tempfile
+import urllib3
+
+
+class UnsafeImageURL(Exception):
+    """Raised for image URLs that aren't http(s) or point at a private address"""
+
+
+class ImageFetchError(Exception):
+    """Raised when a source image can't be downloaded"""
+
+
+class ImageProxy:
+    """Resized WebP copies of recipe, ingredient and profile images, served from our own domain.
+
+    Each source URL is fetched once per size, shrunk to fit the size with Pillow and
+    kept on disk, where the least recently used files are removed once the cache
+    is bigger than max_bytes. Proxy URLs are signed with SECRET_KEY so only images
+    the app links to can be fetched, and sources on private addresses are refused.
+    Fetches connect to the exact address that was checked, so a DNS answer that
+    changes in between can't point them at a private one.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, quality=80, timeout=5, max_source_bytes=10 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.timeout = timeout
+        self.max_source_bytes = max_source_bytes
+        self.sizes = {'card': (312, 231), 'hero': (556, 370), 'thumb': (100, 100), 'avatar': (96, 96)}
+        self.directory = None
+        self.secret = b''
+        self.flights = SingleFlight()
+        self._pools = None
+        self._size = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def init_app(self, app):
+        """Read the cache directory, its size limit (in bytes) and the image sizes from the app config"""
+        self.directory = app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+        self.max_bytes = app.config.setdefault('IMAGE_CACHE_MAX_BYTES', self.max_bytes)
+        self.quality = app.config.setdefault('IMAGE_QUALITY', self.quality)
+        self.timeout = app.config.setdefault('IMAGE_TIMEOUT', self.timeout)
+        self.max_source_bytes = app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', self.max_source_bytes)
+        self.sizes = app.config.setdefault('IMAGE_SIZES', self.sizes)
+        self.secret = app.config['SECRET_KEY'].encode('UTF-8')
+
+        app.add_url_rule('/images/<size>', 'image', self.image_view)
+        app.add_template_global(self.url, 'thumbnail')
+
+    def reset(self):
+        """Forget the connection pools, so a forked worker makes its own"""
+        self._pools = None
+        self.flights = SingleFlight()
+
+    @property
+    def pools(self):
+        if self._pools is None:
+            self._pools = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+        return self._pools
+
+    def url(self, source, size='card'):
+        """Proxy URL for source at size, or source itself if it's already one of our own paths"""
+        if not source or not source.startswith(('http://', 'https://')):
+            return source
+        return url_for('image', size=size, url=source, sig=self.sign(size, source))
+
+    def sign(self, size, source):
+        return hmac.new(self.secret, f'{ size }:{ source }'.encode('UTF-8'), hashlib.sha256).hexdigest()[:32]
+
+    def image_view(self, size):
+        """Serve a cached thumbnail, making it first if needed. Sources that can't be fetched are linked to directly."""
+        source = request.args.get('url', '')
+        if size not in self.sizes or not hmac.compare_digest(request.args.get('sig', ''), self.sign(size, source)):
+            abort(404)
+
+        key = hashlib.sha256(f'{ size }:{ source }'.encode('UTF-8')).hexdigest()
+        path = os.path.join(self.directory, f'{ key }.webp')
+
+        if os.path.exists(path):
+            with self._lock:
+                self.hits += 1
+            os.utime(path)
+        else:
+            with self._lock:
+                self.misses += 1
+            try:
+                self.flights.do(key, lambda: self._store(path, self._thumbnail(source, self.sizes[size])))
+            except UnsafeImageURL:
+                abort(404)
+            except (ImageFetchError, OSError, Image.DecompressionBombError):
+                with self._lock:
+                    self.errors += 1
+                return redirect(source)
+
+        response = send_file(path, mimetype='image/webp', max_age=60 * 60 * 24 * 365, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors, 'bytes': self._size}
+
+    def _fetch(self, source):
+        """GET source, following up to 3 redirects, refusing private addresses and anything over max_source_bytes"""
+        for _ in range(4):
+            try:
+                res = self._get(source)
+            except urllib3.exceptions.HTTPError as error:
+                raise ImageFetchError(f'{ source }: { error }')
+
+            try:
+                if res.get_redirect_location():
+                    source = urljoin(source, res.get_redirect_location())
+                    continue
+                if res.status >= 400:
+                    raise ImageFetchError(f'{ source } returned { res.status }')
+
+                data = bytearray()
+                for chunk in res.stream(64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_source_bytes:
+                        raise ImageFetchError(f'{ source } is bigger than { self.max_source_bytes } bytes')
+                return bytes(data)
+            except urllib3.exceptions.HTTPError as error:
+                raise ImageFetchError(f'{ source }: { error }')
+            finally:
+                if not res.isclosed():
+                    """Don't hand a connection with part of a body still unread back to the pool"""
+                    res.close()
+                res.release_conn()
+
+        raise ImageFetchError(f'{ source } redirected too many times')
+
+    def _get(self, source):
+        """Start a GET for source on a connection to the public address check_public() found for it"""
+        parsed = urlparse(source)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        address = check_public(source)
+
+        """TLS still checks the certificate against the hostname, and the Host header names it"""
+        pool_kwargs = {'server_hostname': parsed.hostname, 'assert_hostname': parsed.hostname} if parsed.scheme == 'https' else {}
+        pool = self.pools.connection_from_host(address, port, parsed.scheme, pool_kwargs=pool_kwargs)
+
+        path = parsed.path or '/'
+        if parsed.query:
+            path += f'?{ parsed.query }'
+        host = parsed.hostname if parsed.port is None else f'{ parsed.hostname }:{ parsed.port }'
+
+        return pool.urlopen('GET', path, headers={'Host': host}, redirect=False, retries=False, assert_same_host=False,
+                            preload_content=False, timeout=urllib3.Timeout(self.timeout))
+
+    def _thumbnail(self, source, size):
+        """Fetch source and return it as WebP, cropped to fill size"""
+        image = Image.open(BytesIO(self._fetch(source)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+
+        output = BytesIO()
+        image.save(output, 'WEBP', quality=self.quality, method=4)
+        return output.getvalue()
+
+    def _store(self, path, data):
+        """Write data to path atomically, then trim the cache if it's now too big"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.webp'))
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used files until the cache is at 90% of max_bytes. Other processes share the directory, so it's rescanned."""
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.directory) if entry.name.endswith('.webp'))
+        size = sum(entry_size for mtime, entry_size, path in entries)
+
+        for mtime, entry_size, path in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except FileNotFoundError:
+                pass
+
+        self._size = size
+
+
+def check_public(source):
+    """Return the address to connect to for source.
+
+    Raises UnsafeImageURL unless source is http(s) on a host that only resolves to public addresses.
+    """
+    parsed = urlparse(source)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise UnsafeImageURL(source)
+
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80))
+    except socket.gaierror:
+        raise UnsafeImageURL(source)
+
+    for family, type, proto, canonname, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0]).is_global:
+            raise UnsafeImageURL(source)
+
+    return addresses[0][4][0]
+
+
+image_proxy = ImageProxy()
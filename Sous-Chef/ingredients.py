@@ -0,0 +1,108 @@
+from threading import Lock
+from cache import LookupCache
+from search import singular
+from spoonacular import spoonacular
+import re
+
+
+def clean_ingredient(name):
+    """Lowercase and collapse whitespace, the form sent to Spoonacular"""
+    return ' '.join((name or '').lower().split())
+
+
+def normalize_ingredient(name):
+    """Lowercase, collapse whitespace and singularize, so "Butters " and "butter" are the same lookup"""
+    return ' '.join(singular(word) for word in re.findall(r"[a-z0-9']+", (name or '').lower()))
+
+
+class IngredientTrie:
+    """Prefix trie over known ingredient names, for typeahead"""
+
+    def __init__(self):
+        self._root = {}
+        self._lock = Lock()
+
+    def add(self, name):
+        key = normalize_ingredient(name)
+        if not key:
+            return
+
+        with self._lock:
+            node = self._root
+            for char in key:
+                node = node.setdefault(char, {})
+            node.setdefault('$', name.strip().lower())
+
+    def complete(self, prefix, limit=10):
+        """Return up to limit known names starting with prefix, shortest first.
+
+        The prefix is normalized the same way add() normalizes names, so "tomatoes" finds "tomato".
+        """
+        key = normalize_ingredient(prefix)
+        if not key:
+            return []
+
+        with self._lock:
+            node = self._root
+            for char in key:
+                node = node.get(char)
+                if node is None:
+                    return []
+
+            names = []
+            level = [node]
+            while level and len(names) < limit:
+                next_level = []
+                for node in level:
+                    for char, child in sorted(node.items()):
+                        if char == '$':
+                            names.append(child)
+                        else:
+                            next_level.append(child)
+                level = next_level
+
+        return names[:limit]
+
+
+class IngredientLookup:
+    """Memoized substitute and ingredient search lookups, keyed on the normalized name"""
+
+    def __init__(self):
+        self.substitutes_cache = LookupCache(is_negative=lambda info: info.get('status') != 'success')
+        self.search_cache = LookupCache(is_negative=lambda info: len(info.get('results', [])) == 0)
+        self.names = IngredientTrie()
+
+    def init_app(self, app):
+        """Read cache sizes and TTLs (in seconds) from the app config"""
+        for cache in (self.substitutes_cache, self.search_cache):
+            cache.max_size = app.config.setdefault('INGREDIENT_CACHE_SIZE', cache.max_size)
+            cache.ttl = app.config.setdefault('INGREDIENT_CACHE_TTL', cache.ttl)
+            cache.negative_ttl = app.config.setdefault('INGREDIENT_CACHE_NEGATIVE_TTL', cache.negative_ttl)
+
+    def substitutes(self, name):
+        """Cached under the normalized name, but Spoonacular is asked about what was typed"""
+        info = self.substitutes_cache.get(normalize_ingredient(name), lambda key: self._fetch_substitutes(clean_ingredient(name)))
+        if info.get('status') == 'success':
+            self.names.add(info['ingredient'])
+        return info
+
+    def search(self, name):
+        info = self.search_cache.get(normalize_ingredient(name), lambda key: self._fetch_search(clean_ingredient(name)))
+        for result in info.get('results', []):
+            self.names.add(result['name'])
+        return info
+
+    def add_names(self, recipes):
+        """Learn ingredient names from the extendedIngredients of fetched recipes"""
+        for recipe_info in recipes:
+            for ingredient in recipe_info.get('extendedIngredients', []):
+                self.names.add(ingredient.get('nameClean') or ingredient.get('name') or '')
+
+    def _fetch_substitutes(self, name):
+        return spoonacular.get('/food/ingredients/substitutes', ingredientName=name)
+
+    def _fetch_search(self, name):
+        return spoonacular.get('/food/ingredients/search', query=name)
+
+
+ingredient_lookup = IngredientLookup()
@@ -0,0 +1,187 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import func, text
+from sqlalchemy.orm import aliased
+from models import db, Job
+import json
+import logging
+import multiprocessing
+import time
+
+
+logger = logging.getLogger(__name__)
+
+Task = namedtuple('Task', ['func', 'max_attempts', 'concurrency'])
+
+
+class JobQueue:
+    """Background jobs kept in the jobs table and run by `flask worker`.
+
+    Jobs are added to the caller's session by enqueue(), so they're saved, or
+    not, with the rest of the request's changes. Workers claim a job by flipping
+    its status with a conditional UPDATE. SQLite runs one write at a time, so that
+    is enough there; on Postgres the claim also holds an advisory lock on the task
+    name, so two workers can't both see a free concurrency slot. A failed job is
+    retried with exponential backoff until it runs out of attempts, and a task's
+    concurrency caps how many of its jobs run at once.
+    """
+
+    def __init__(self, poll_interval=1, retry_delay=30, timeout=60 * 10):
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.tasks = {}
+
+    def init_app(self, app):
+        """Read polling, retry backoff and stuck job timeout (in seconds) from the app config"""
+        self.poll_interval = app.config.setdefault('JOB_POLL_INTERVAL', self.poll_interval)
+        self.retry_delay = app.config.setdefault('JOB_RETRY_DELAY', self.retry_delay)
+        self.timeout = app.config.setdefault('JOB_TIMEOUT', self.timeout)
+
+    def task(self, name, max_attempts=3, concurrency=1):
+        """Register a function to run jobs called name, with their payload as keyword arguments"""
+        def register(func):
+            self.tasks[name] = Task(func, max_attempts, concurrency)
+            return func
+        return register
+
+    def enqueue(self, name, delay=0, **payload):
+        """Add a job to the session, it's queued once the caller commits"""
+        job = Job(name=name, payload=json.dumps(payload), run_at=datetime.utcnow() + timedelta(seconds=delay))
+        db.session.add(job)
+        return job
+
+    def stats(self):
+        """Jobs per task and status, plus how many are waiting and for how long"""
+        rows = (db.session.query(Job.name, Job.status, func.count(Job.id), func.min(Job.run_at))
+                          .group_by(Job.name, Job.status)
+                          .all())
+
+        now = datetime.utcnow()
+        tasks = {}
+        depth = 0
+        oldest = None
+        for name, status, count, run_at in rows:
+            tasks.setdefault(name, {})[status] = count
+            if status == 'queued':
+                depth += count
+                if run_at <= now and (oldest is None or run_at < oldest):
+                    oldest = run_at
+
+        return {
+            'depth': depth,
+            'oldest_queued_seconds': round((now - oldest).total_seconds(), 1) if oldest else 0,
+            'tasks': tasks
+        }
+
+    def run(self, create_app, processes=1, after_fork=None):
+        """Work jobs from processes worker processes until interrupted.
+
+        Each process builds its own app with create_app(), so only module level
+        functions are handed to it and it works with fork and spawn alike.
+        """
+        if processes == 1:
+            self._work_in_process(create_app, None)
+            return
+
+        workers = [multiprocessing.Process(target=self._work_in_process, args=(create_app, after_fork)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def _work_in_process(self, create_app, after_fork):
+        app = create_app()
+        if after_fork is not None:
+            after_fork(app)
+        with app.app_context():
+            self.work()
+
+    def work(self, once=False):
+        """Claim and run jobs, sleeping poll_interval when there's nothing to do. once stops when the queue is empty."""
+        requeued_at = 0
+        while True:
+            if time.monotonic() - requeued_at > self.timeout / 2:
+                self.requeue_stuck()
+                requeued_at = time.monotonic()
+
+            job = self.claim()
+            if job is not None:
+                self.run_job(job)
+            elif once:
+                return
+            else:
+                time.sleep(self.poll_interval)
+
+    def claim(self):
+        """Mark the next runnable job as running and return it, or None if there isn't one"""
+        now = datetime.utcnow()
+        candidates = (db.session.query(Job.id, Job.name)
+                                .filter(Job.status == 'queued', Job.run_at <= now)
+                                .order_by(Job.run_at, Job.id)
+                                .limit(20)
+                                .all())
+
+        for id, name in candidates:
+            task = self.tasks.get(name)
+            if task is None:
+                Job.query.filter(Job.id == id).update({'status': 'failed', 'last_error': f'No task called { name }'})
+                db.session.commit()
+                continue
+
+            if db.engine.dialect.name == 'postgresql':
+                """Held until the commit below, so claims for the same task take turns"""
+                db.session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:name))'), {'name': name})
+
+            running = aliased(Job)
+            running_count = (db.session.query(func.count(running.id))
+                                       .filter(running.name == name, running.status == 'running')
+                                       .scalar_subquery())
+
+            claimed = (Job.query
+                          .filter(Job.id == id, Job.status == 'queued', running_count < task.concurrency)
+                          .update({'status': 'running', 'locked_at': now, 'attempts': Job.attempts + 1},
+                                  synchronize_session=False))
+            db.session.commit()
+
+            if claimed:
+                return db.session.get(Job, id)
+
+        return None
+
+    def run_job(self, job):
+        """Run a claimed job, deleting it when it succeeds and scheduling a retry when it doesn't"""
+        id = job.id
+        task = self.tasks[job.name]
+
+        try:
+            task.func(**json.loads(job.payload))
+            Job.query.filter(Job.id == id).delete()
+            db.session.commit()
+            return
+        except Exception as error:
+            db.session.rollback()
+            logger.exception('Job %d (%s) failed', id, job.name)
+            last_error = repr(error)
+
+        job = db.session.get(Job, id)
+        job.last_error = last_error
+        job.locked_at = None
+        if job.attempts < task.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=self.retry_delay * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'failed'
+        db.session.commit()
+
+    def requeue_stuck(self):
+        """Put back jobs whose worker died while running them"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.timeout)
+        requeued = (Job.query
+                       .filter(Job.status == 'running', Job.locked_at < cutoff)
+                       .update({'status': 'queued', 'locked_at': None}, synchronize_session=False))
+        db.session.commit()
+        return requeued
+
+
+job_queue = JobQueue()
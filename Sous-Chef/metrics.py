@@ -0,0 +1,198 @@
+from collections import Counter
+from threading import Lock
+from flask import g, request, jsonify, abort, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from spoonacular import upstream_called, call_tag
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf')]
+PARTS = ['db', 'upstream', 'render', 'total']
+
+
+class Histogram:
+    """Request durations counted into fixed millisecond buckets"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, ms):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += ms
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_ms': round(self.sum, 3),
+            'buckets': {('+Inf' if bound == float('inf') else str(bound)): count for bound, count in zip(BUCKETS_MS, self.counts)}
+        }
+
+
+class PerformanceMetrics:
+    """Per request time spent in SQL, Spoonacular calls and template rendering.
+
+    Each response gets a Server-Timing header, totals are kept as per route histograms
+    on /metrics (local requests only) once the whole body has been sent, and a request running the same SQL statement
+    n_plus_one_threshold times or more is logged as a likely N+1.
+    """
+
+    def __init__(self, n_plus_one_threshold=5):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.routes = {}
+        self.n_plus_one = Counter()
+        self.stats = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.n_plus_one_threshold = app.config.setdefault('N_PLUS_ONE_THRESHOLD', self.n_plus_one_threshold)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+        if not event.contains(Engine, 'before_cursor_execute', self._before_query):
+            event.listen(Engine, 'before_cursor_execute', self._before_query)
+            event.listen(Engine, 'after_cursor_execute', self._after_query)
+        upstream_called.connect(self._upstream, weak=False)
+        before_render_template.connect(self._before_render, app, weak=False)
+        template_rendered.connect(self._after_render, app, weak=False)
+
+    def add_stats(self, name, func):
+        """Show func() under name on /metrics"""
+        self.stats[name] = func
+
+    def _start(self):
+        g._perf = {'started': time.perf_counter(), 'db': 0, 'upstream': 0, 'render': 0,
+                   'upstream_calls': 0, 'statements': Counter()}
+        """Spoonacular calls made on its thread pool for this request are tagged with its timings"""
+        call_tag.set(g._perf)
+
+    def _timings(self):
+        if has_request_context():
+            return g.get('_perf')
+        return None
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        timings = self._timings()
+        if timings is not None:
+            timings['db'] += time.perf_counter() - started
+            timings['statements'][statement] += 1
+
+    def _upstream(self, sender, path, duration, tag=None):
+        timings = tag if tag is not None else self._timings()
+        if timings is not None:
+            with self._lock:
+                timings['upstream'] += duration
+                timings['upstream_calls'] += 1
+
+    def _before_render(self, sender, template, context):
+        timings = self._timings()
+        if timings is not None:
+            timings['render_started'] = time.perf_counter()
+
+    def _after_render(self, sender, template, context):
+        timings = self._timings()
+        if timings is not None and 'render_started' in timings:
+            timings['render'] += time.perf_counter() - timings.pop('render_started')
+
+    def _finish(self, response):
+        timings = g.get('_perf')
+        if timings is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        if response.is_streamed:
+            """The body hasn't been generated yet. The header can only cover the time before it
+            starts, and the histograms are updated once the server has sent the whole body."""
+            response.headers['Server-Timing'] = self._server_timing(timings, 'start', 'before the body streamed')
+            response.call_on_close(lambda: self._closed(route, timings))
+            return response
+
+        g.pop('_perf')
+        call_tag.set(None)
+        response.headers['Server-Timing'] = self._server_timing(timings, 'total')
+        self._record(route, timings)
+        return response
+
+    def _closed(self, route, timings):
+        call_tag.set(None)
+        self._record(route, timings)
+
+    def _durations(self, timings):
+        return {
+            'db': timings['db'] * 1000,
+            'upstream': timings['upstream'] * 1000,
+            'render': timings['render'] * 1000,
+            'total': (time.perf_counter() - timings['started']) * 1000
+        }
+
+    def _server_timing(self, timings, total_name, total_desc=None):
+        durations = self._durations(timings)
+        queries = sum(timings['statements'].values())
+        total = f'{ total_name };dur={ durations["total"]:.1f}'
+        if total_desc:
+            total += f';desc="{ total_desc }"'
+
+        return ', '.join([
+            f'db;dur={ durations["db"]:.1f};desc="{ queries } queries"',
+            f'upstream;dur={ durations["upstream"]:.1f};desc="{ timings["upstream_calls"] } calls"',
+            f'render;dur={ durations["render"]:.1f}',
+            total
+        ])
+
+    def _record(self, route, timings):
+        """Add a finished request to its route's histograms and log likely N+1 queries"""
+        durations = self._durations(timings)
+        queries = sum(timings['statements'].values())
+        repeated = [statement for statement, count in timings['statements'].items() if count >= self.n_plus_one_threshold]
+
+        with self._lock:
+            stats = self.routes.setdefault(route, {'queries': 0, 'upstream_calls': 0, **{part: Histogram() for part in PARTS}})
+            stats['queries'] += queries
+            stats['upstream_calls'] += timings['upstream_calls']
+            for part in PARTS:
+                stats[part].observe(durations[part])
+            for statement in repeated:
+                self.n_plus_one[(route, statement)] += 1
+
+        for statement in repeated:
+            logger.warning('Possible N+1 on %s: ran %d times in one request: %s',
+                           route, timings['statements'][statement], statement)
+
+    def metrics_view(self):
+        """Per route timing histograms, for local requests only"""
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            abort(404)
+
+        with self._lock:
+            return jsonify({
+                'routes': {
+                    route: {
+                        'queries': stats['queries'],
+                        'upstream_calls': stats['upstream_calls'],
+                        **{part: stats[part].to_dict() for part in PARTS}
+                    }
+                    for route, stats in self.routes.items()
+                },
+                'n_plus_one': [{'route': route, 'statement': statement, 'requests': count}
+                               for (route, statement), count in self.n_plus_one.most_common()],
+                **{name: func() for name, func in self.stats.items()}
+            })
+
+
+performance = PerformanceMetrics()
@@ -0,0 +1,181 @@
+"""Bring an existing database up to date with models.py.
+
+db.create_all() only creates missing tables, so columns added to existing tables and
+data backfills live here. Every migration is safe to run more than once.
+
+    flask migrate
+    python migrations.py
+"""
+from sqlalchemy import inspect, text, func, case
+from app import create_app, queue_order_backfill
+from cache import recipe_cache
+from models import db, Favorite, Review, Order, OrderItem, CachedRecipe, RecipeRatingSummary
+import json
+
+
+def has_column(table, column):
+    return column in [col['name'] for col in inspect(db.engine).get_columns(table)]
+
+
+def add_column(table, column, column_type):
+    if not has_column(table, column):
+        with db.engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE { table } ADD COLUMN { column } { column_type }'))
+
+
+def split_order_headers():
+    """Move the old one-row-per-line-item orders table into orders + order_items"""
+    if not has_column('orders', 'ingredient_id'):
+        return
+
+    has_snapshot = has_column('orders', 'ingredient_name')
+
+    with db.engine.begin() as conn:
+        old_rows = conn.execute(text('SELECT * FROM orders ORDER BY user_id, order_id, id')).mappings().all()
+
+        OrderItem.__table__.drop(conn, checkfirst=True)
+        conn.execute(text('DROP TABLE orders'))
+        Order.__table__.create(conn)
+        OrderItem.__table__.create(conn)
+
+        headers = {}
+        line_items = []
+        for row in old_rows:
+            key = (row['user_id'], row['order_id'])
+            if key not in headers:
+                headers[key] = conn.execute(Order.__table__.insert().values(user_id=row['user_id'])).inserted_primary_key[0]
+
+            line_items.append({
+                'order_id': headers[key],
+                'ingredient_id': row['ingredient_id'],
+                'ingredient_count': row['ingredient_count'],
+                'ingredient_price': row['ingredient_price'],
+                'ingredient_name': row['ingredient_name'] if has_snapshot else None,
+                'ingredient_image': row['ingredient_image'] if has_snapshot else None
+            })
+
+        if len(line_items) > 0:
+            conn.execute(OrderItem.__table__.insert(), line_items)
+
+
+def order_ingredient_snapshot():
+    """Queue jobs that store ingredient name and image on every order item.
+
+    The lookups cost Spoonacular points and can fail, so they run in `flask worker`
+    rather than here, where an error would stop the migrations after this one.
+    """
+    add_column('order_items', 'ingredient_name', 'VARCHAR')
+    add_column('order_items', 'ingredient_image', 'VARCHAR')
+    add_column('order_items', 'backfill_queued', 'BOOLEAN NOT NULL DEFAULT FALSE')
+
+    batch_size = 100
+    while True:
+        ids = [id for id, in (db.session.query(OrderItem.id)
+                                        .filter(OrderItem.ingredient_name.is_(None), OrderItem.backfill_queued.is_(False))
+                                        .order_by(OrderItem.id)
+                                        .limit(batch_size))]
+        if len(ids) == 0:
+            break
+
+        queue_order_backfill(ids)
+        db.session.commit()
+
+
+def remove_duplicates(table, columns):
+    """Keep only the oldest row for each combination of columns"""
+    columns = ', '.join(columns)
+    with db.engine.begin() as conn:
+        conn.execute(text(f'DELETE FROM { table } WHERE id NOT IN (SELECT MIN(id) FROM { table } GROUP BY { columns })'))
+
+
+def lookup_indexes():
+    """Index the columns favorites, reviews and orders are looked up by"""
+    remove_duplicates('favorites', ['user_id', 'recipe_id'])
+    remove_duplicates('reviews', ['user_id', 'recipe_id'])
+
+    for model in [Favorite, Review, Order, OrderItem]:
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def recipe_cache_title_image():
+    """Copy title and image out of the cached JSON so they can be joined against"""
+    add_column('recipe_cache', 'title', 'VARCHAR')
+    add_column('recipe_cache', 'image', 'VARCHAR')
+
+    for cached in CachedRecipe.query.filter(CachedRecipe.title.is_(None)).all():
+        recipe_info = json.loads(cached.data)
+        cached.title = recipe_info.get('title')
+        cached.image = recipe_info.get('image')
+    db.session.commit()
+
+
+def review_keyset_index():
+    """Reviews are paged by (recipe_id, id), which replaces the recipe_id only index"""
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX IF EXISTS ix_reviews_recipe_id'))
+
+    for index in Review.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def rating_summaries():
+    """Rebuild every recipe's rating summary from its reviews"""
+    rows = (db.session.query(Review.recipe_id,
+                             func.count(Review.id),
+                             func.sum(Review.rating),
+                             func.max(Review.id),
+                             *[func.sum(case((Review.rating == star, 1), else_=0)) for star in range(1, 6)])
+                      .group_by(Review.recipe_id)
+                      .all())
+
+    RecipeRatingSummary.query.delete()
+    if len(rows) > 0:
+        db.session.execute(RecipeRatingSummary.__table__.insert(), [{
+            'recipe_id': recipe_id,
+            'review_count': count,
+            'rating_sum': total,
+            'last_review_id': last_review_id,
+            **{f'stars_{ star }': stars[star - 1] for star in range(1, 6)}
+        } for recipe_id, count, total, last_review_id, *stars in rows])
+    db.session.commit()
+
+
+def purge_bad_recipe_cache():
+    """Delete cached rows that hold an error body or a partial recipe instead of recipe info"""
+    print(f'Removed { recipe_cache.purge_invalid() } bad recipe_cache rows')
+
+
+def user_recipe_ids_version():
+    """Version users' favorites and reviews, so every process can tell when its cached copy is out of date"""
+    add_column('users', 'recipe_ids_version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def browser_cart_merged():
+    """Remember which users' browser carts have been merged into cart_items"""
+    add_column('users', 'browser_cart_merged', 'BOOLEAN NOT NULL DEFAULT FALSE')
+
+
+MIGRATIONS = [
+    split_order_headers,
+    order_ingredient_snapshot,
+    lookup_indexes,
+    recipe_cache_title_image,
+    review_keyset_index,
+    rating_summaries,
+    purge_bad_recipe_cache,
+    user_recipe_ids_version,
+    browser_cart_merged,
+]
+
+
+def run_migrations():
+    db.create_all()
+    for migration in MIGRATIONS:
+        print(f'Running { migration.__name__ }')
+        migration()
+
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        run_migrations()
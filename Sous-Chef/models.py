@@ -1,8 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from datetime import datetime
+from passwords import password_pool, login_limiter
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 def connect_db(app):
     """Connect to database."""
@@ -21,14 +21,17 @@ class User(db.Model):
     password = db.Column(db.String, nullable=False)
     email = db.Column(db.String(50), nullable=False, unique=True)
     profile_pic = db.Column(db.String, default="/static/images/def_pfp.jpeg")
+    recipe_ids_version = db.Column(db.Integer, nullable=False, default=0)
+    browser_cart_merged = db.Column(db.Boolean, nullable=False, default=False)
 
     favorites = db.relationship('Favorite', backref='users', cascade='all, delete')
     reviews = db.relationship('Review', backref='users', cascade='all, delete')
-    orders = db.relationship('Order', backref='users', order_by='Order.order_id.desc()', cascade='all, delete')
+    orders = db.relationship('Order', backref='users', order_by='Order.id.desc()', cascade='all, delete')
+    cart = db.relationship('CartItem', backref='users', order_by='CartItem.id', cascade='all, delete')
 
     @classmethod
     def register(cls, first_name, last_name, username, email, profile_pic, password):
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             first_name=first_name,
@@ -45,11 +48,28 @@ class User(db.Model):
     @classmethod
     def authenticate(cls, username, password):
         user = User.query.filter_by(username=username).first()
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and user.check_password(password):
             return user
         else:
             return False
 
+    def check_password(self, password):
+        """Check password on the password pool, counting failures against this username.
+
+        A hash made with an old work factor is replaced, callers commit to keep it.
+        """
+        if not login_limiter.allowed(self.username):
+            return False
+
+        if not password_pool.check(self.password, password):
+            login_limiter.failed(self.username)
+            return False
+
+        login_limiter.succeeded(self.username)
+        if password_pool.needs_rehash(self.password):
+            self.password = password_pool.hash(password)
+        return True
+
     def __repr__(self):
         u = self
         return f"<User {u.id} username={u.username} first_name={u.first_name} last_name={u.last_name} email={u.email}>"
@@ -57,6 +77,9 @@ class User(db.Model):
 
 class Favorite(db.Model):
     __tablename__ = 'favorites'
+    __table_args__ = (
+        db.Index('ix_favorites_user_id_recipe_id', 'user_id', 'recipe_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
@@ -65,6 +88,10 @@ class Favorite(db.Model):
 
 class Review(db.Model):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        db.Index('ix_reviews_user_id_recipe_id', 'user_id', 'recipe_id', unique=True),
+        db.Index('ix_reviews_recipe_id_id', 'recipe_id', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
@@ -72,11 +99,111 @@ class Review(db.Model):
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.String)
 
+class RecipeRatingSummary(db.Model):
+    """Review count, rating total and star histogram for a recipe, updated along with every review"""
+    __tablename__ = 'recipe_rating_summary'
+
+    recipe_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+    last_review_id = db.Column(db.Integer)
+
+    @property
+    def average(self):
+        return round(self.rating_sum / self.review_count, 2) if self.review_count else None
+
+    @property
+    def histogram(self):
+        return [self.stars_1, self.stars_2, self.stars_3, self.stars_4, self.stars_5]
+
+
 class Order(db.Model):
+    """One checkout by a user"""
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_user_id_id', 'user_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    order_id = db.Column(db.Integer, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    items = db.relationship('OrderItem', backref='order', order_by='OrderItem.id', cascade='all, delete')
+
+
+class OrderItem(db.Model):
+    """One ingredient line in an order"""
+    __tablename__ = 'order_items'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=False, index=True)
     ingredient_id = db.Column(db.Integer, nullable=False)
     ingredient_count = db.Column(db.Integer, default=1)
     ingredient_price = db.Column(db.Float, nullable=False)
+    ingredient_name = db.Column(db.String)
+    ingredient_image = db.Column(db.String)
+    backfill_queued = db.Column(db.Boolean, nullable=False, default=False)
+
+
+class CartItem(db.Model):
+    """One ingredient in a user's cart, stored with everything needed to show and order it"""
+    __tablename__ = 'cart_items'
+    __table_args__ = (
+        db.Index('ix_cart_items_user_id_ingredient_id', 'user_id', 'ingredient_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    ingredient_id = db.Column(db.Integer, nullable=False)
+    ingredient_name = db.Column(db.String)
+    ingredient_image = db.Column(db.String)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    price_cents = db.Column(db.Integer, nullable=False)
+    total_cents = db.Column(db.Integer, nullable=False)
+
+    def set_count(self, count):
+        self.count = count
+        self.total_cents = count * self.price_cents
+
+
+class CachedRecipe(db.Model):
+    """Recipe information fetched from Spoonacular, stored as raw JSON"""
+    __tablename__ = 'recipe_cache'
+
+    recipe_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String)
+    image = db.Column(db.String)
+    data = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class Job(db.Model):
+    """A unit of background work waiting for, or being run by, `flask worker`"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class QuotaBucket(db.Model):
+    """Spoonacular point bucket shared by every process, see quota.SharedTokenBucket"""
+    __tablename__ = 'quota_buckets'
+
+    name = db.Column(db.String, primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False)
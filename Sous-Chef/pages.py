@@ -0,0 +1,52 @@
+from flask import request, session, make_response
+from cache import LookupCache
+import hashlib
+import json
+
+
+class PageCache:
+    """User independent parts of pages, and ETags for whole pages.
+
+    Fragments are keyed by name, key and a content version, so a changed version is
+    just a miss and the old entry ages out of the LRU. A GET whose If-None-Match still
+    matches gets a 304 before the template is rendered.
+    """
+
+    def __init__(self, max_size=1024, ttl=60 * 60):
+        self.fragments = LookupCache(max_size, ttl)
+        self.version = '1'
+
+    def init_app(self, app):
+        """PAGE_CACHE_VERSION is part of every ETag, change it when templates change"""
+        self.fragments.max_size = app.config.setdefault('PAGE_CACHE_SIZE', self.fragments.max_size)
+        self.fragments.ttl = app.config.setdefault('PAGE_CACHE_TTL', self.fragments.ttl)
+        self.version = str(app.config.setdefault('PAGE_CACHE_VERSION', self.version))
+
+    def fragment(self, name, key, version, build):
+        """Return the cached fragment for (name, key, version), calling build() on a miss"""
+        return self.fragments.get((name, key, version), lambda _: build())
+
+    def etag(self, *parts):
+        """Strong ETag over anything JSON can serialize"""
+        data = json.dumps([self.version, *parts], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('UTF-8')).hexdigest()
+
+    def conditional(self, etag, render):
+        """304 if the client already has etag, otherwise render() with the ETag attached.
+
+        Pages with flashed messages waiting are always rendered, so the message isn't lost.
+        """
+        if request.method in ('GET', 'HEAD') and '_flashes' not in session and request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(render())
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def stats(self):
+        return self.fragments.stats()
+
+
+page_cache = PageCache()
@@ -0,0 +1,188 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+import bcrypt
+import time
+
+
+class PasswordQueueFull(Exception):
+    """Raised when too many password checks are already waiting, or one waited longer than the timeout"""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(password_hash, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), password_hash.encode('UTF-8'))
+
+
+class PasswordPool:
+    """Runs bcrypt on a small process pool instead of the request thread.
+
+    At most max_queue hashes or checks can be waiting at once, so a login burst
+    gets turned away instead of tying up every worker thread. A slot stays taken
+    until the pool is done with the task, even if the caller gave up on it, and a
+    pool whose process died is replaced.
+    """
+
+    def __init__(self, rounds=12, workers=2, max_queue=32, timeout=10):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._slots = BoundedSemaphore(max_queue)
+        self._lock = Lock()
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rebuilt = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def init_app(self, app):
+        """BCRYPT_LOG_ROUNDS is the same setting Flask-Bcrypt reads"""
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.setdefault('PASSWORD_WORKERS', self.workers)
+        self.max_queue = app.config.setdefault('PASSWORD_MAX_QUEUE', self.max_queue)
+        self.timeout = app.config.setdefault('PASSWORD_TIMEOUT', self.timeout)
+        self._slots = BoundedSemaphore(self.max_queue)
+
+    def reset(self):
+        """Forget the process pool, so a forked worker starts its own"""
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, password_hash, password):
+        return self._run(_check, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with a different work factor than the configured one"""
+        return int(password_hash.split('$')[2]) != self.rounds
+
+    def stats(self):
+        with self._lock:
+            return {
+                'waiting': self.waiting,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'rebuilt': self.rebuilt,
+                'avg_wait_ms': round(self.total_wait / self.completed * 1000, 1) if self.completed else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 1)
+            }
+
+    def _run(self, func, *args):
+        """Run func(*args) on the pool, trying once more on a new pool if a process died"""
+        try:
+            return self._attempt(func, *args)
+        except BrokenProcessPool:
+            return self._attempt(func, *args)
+
+    def _attempt(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordQueueFull()
+
+        started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+        def finished(future):
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.waiting -= 1
+                self.completed += 1
+                self.total_wait += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+            self._slots.release()
+
+        executor = self.executor
+        try:
+            future = executor.submit(func, *args)
+        except BaseException as error:
+            finished(None)
+            if isinstance(error, BrokenProcessPool):
+                self._rebuild(executor)
+            raise
+        future.add_done_callback(finished)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            """Drop it if it hasn't started yet, otherwise its slot is freed when it finishes"""
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise PasswordQueueFull()
+        except BrokenProcessPool:
+            self._rebuild(executor)
+            raise
+
+    def _rebuild(self, broken):
+        """Replace a pool whose worker process died, unless another thread already has"""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = None
+            self.rebuilt += 1
+        broken.shutdown(wait=False)
+
+
+class LoginRateLimiter:
+    """Allows max_failures failed logins per username in any window of seconds"""
+
+    def __init__(self, max_failures=5, window=60 * 5):
+        self.max_failures = max_failures
+        self.window = window
+        self._failures = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.max_failures = app.config.setdefault('LOGIN_MAX_FAILURES', self.max_failures)
+        self.window = app.config.setdefault('LOGIN_FAILURE_WINDOW', self.window)
+
+    def allowed(self, username):
+        with self._lock:
+            failures = self._recent(username)
+            return failures is None or len(failures) < self.max_failures
+
+    def failed(self, username):
+        with self._lock:
+            failures = self._recent(username)
+            if failures is None:
+                failures = self._failures[username] = deque()
+            failures.append(time.monotonic())
+
+    def succeeded(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
+
+    def _recent(self, username):
+        failures = self._failures.get(username)
+        if failures is None:
+            return None
+
+        cutoff = time.monotonic() - self.window
+        while failures and failures[0] < cutoff:
+            failures.popleft()
+        if not failures:
+            del self._failures[username]
+            return None
+        return failures
+
+
+password_pool = PasswordPool()
+login_limiter = LoginRateLimiter()
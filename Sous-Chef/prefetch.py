@@ -0,0 +1,87 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from spoonacular import spoonacular
+
+
+class RandomRecipePool:
+    """Buffers of random recipes, one per filter combination.
+
+    Pages take recipes from memory, and a buffer that runs low is refilled in the
+    background with one large recipes/random call.
+    """
+
+    def __init__(self, batch_size=100, low_water=30, max_workers=2):
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.max_workers = max_workers
+        self._buffers = {}
+        self._refilling = set()
+        self._lock = Lock()
+        self._executor = None
+
+    def init_app(self, app):
+        """Read buffer sizes from the app config"""
+        self.batch_size = app.config.setdefault('RANDOM_RECIPE_BATCH_SIZE', self.batch_size)
+        self.low_water = app.config.setdefault('RANDOM_RECIPE_LOW_WATER', self.low_water)
+
+    def reset(self):
+        """Forget the thread pool and in-flight refills, so a forked worker makes its own"""
+        self._executor = None
+        self._refilling = set()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='recipe-prefetch')
+        return self._executor
+
+    def take(self, tags=None, number=10):
+        """Return number random recipes matching tags, only waiting on the API if the buffer is empty"""
+        key = ','.join(sorted(tags or []))
+
+        recipes = self._pop(key, number)
+        if len(recipes) < number:
+            self._add(key, self.fetch(key, priority='interactive'))
+            recipes.extend(self._pop(key, number - len(recipes)))
+
+        self._schedule_refill(key)
+        return recipes
+
+    def fetch(self, key, priority='background'):
+        params = {'number': self.batch_size}
+        if key:
+            params['tags'] = key
+
+        return spoonacular.get('/recipes/random', priority=priority, **params)['recipes']
+
+    def _add(self, key, recipes):
+        with self._lock:
+            buffer = self._buffers.setdefault(key, deque(maxlen=self.batch_size * 2))
+            buffer.extend(recipes)
+
+    def _pop(self, key, number):
+        recipes = []
+        with self._lock:
+            buffer = self._buffers.setdefault(key, deque(maxlen=self.batch_size * 2))
+            while buffer and len(recipes) < number:
+                recipes.append(buffer.popleft())
+        return recipes
+
+    def _schedule_refill(self, key):
+        with self._lock:
+            if len(self._buffers[key]) >= self.low_water or key in self._refilling:
+                return
+            self._refilling.add(key)
+
+        self.executor.submit(self._refill, key)
+
+    def _refill(self, key):
+        try:
+            self._add(key, self.fetch(key))
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+
+random_recipes = RandomRecipePool()
@@ -0,0 +1,200 @@
+from concurrent.futures import Future
+from threading import Lock
+from sqlalchemy import select, case
+from sqlalchemy.exc import IntegrityError
+from models import QuotaBucket
+import copy
+import time
+
+
+class QuotaExceeded(Exception):
+    """Raised instead of calling Spoonacular when the point budget is used up"""
+
+
+class TokenBucket:
+    """capacity tokens, refilled evenly over per_seconds"""
+
+    def __init__(self, capacity, per_seconds):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def take(self, amount, keep=0):
+        """Take amount tokens, unless that would leave fewer than keep"""
+        return self._change(lambda tokens: tokens - amount if tokens - amount >= keep else None) is not None
+
+    def give(self, amount):
+        """Put back tokens taken for a call that didn't happen"""
+        self._change(lambda tokens: tokens + amount)
+
+    def level(self):
+        return self._change(lambda tokens: tokens)
+
+    def _change(self, change):
+        """Refill, then set the level to change(level) unless that's None. Returns the new level or None."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            tokens = change(self._tokens)
+            if tokens is not None:
+                self._tokens = min(self.capacity, tokens)
+            return tokens
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket kept in the quota_buckets table.
+
+    Every process spends from the same row, and a restart doesn't refill it. Each take
+    or give refills and spends in one conditional UPDATE, so concurrent callers queue
+    on the row lock instead of racing, and a take is only refused for lack of tokens.
+    """
+
+    def __init__(self, name, capacity, per_seconds, engine):
+        super().__init__(capacity, per_seconds)
+        self.name = name
+        self.engine = engine
+
+    def take(self, amount, keep=0):
+        """Take amount tokens, unless that would leave fewer than keep"""
+        now = time.time()
+        refilled = self._refilled(now)
+        return self._update(now, refilled - amount, refilled - amount >= keep)
+
+    def give(self, amount):
+        """Put back tokens taken for a call that didn't happen"""
+        now = time.time()
+        refilled = self._refilled(now)
+        self._update(now, case((refilled + amount > self.capacity, self.capacity), else_=refilled + amount))
+
+    def level(self):
+        table = QuotaBucket.__table__
+        with self.engine.begin() as conn:
+            row = conn.execute(select(table.c.tokens, table.c.updated).where(table.c.name == self.name)).first()
+        if row is None:
+            return self.capacity
+        return min(self.capacity, row.tokens + max(0, time.time() - row.updated) * self.rate)
+
+    def _refilled(self, now):
+        """SQL for the row's level after refilling it up to now, ignoring clocks that are behind the row's"""
+        table = QuotaBucket.__table__
+        elapsed = case((table.c.updated > now, 0), else_=now - table.c.updated)
+        tokens = table.c.tokens + elapsed * self.rate
+        return case((tokens > self.capacity, self.capacity), else_=tokens)
+
+    def _update(self, now, tokens, condition=None):
+        """Set the row's level to tokens where condition holds, creating the row first if needed"""
+        table = QuotaBucket.__table__
+        statement = table.update().where(table.c.name == self.name)
+        if condition is not None:
+            statement = statement.where(condition)
+        statement = statement.values(tokens=tokens, updated=now)
+
+        for _ in range(2):
+            with self.engine.begin() as conn:
+                if conn.execute(statement).rowcount:
+                    return True
+                if conn.execute(select(table.c.name).where(table.c.name == self.name)).first() is not None:
+                    return False
+            self._create(table, now)
+        return False
+
+    def _create(self, table, now):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(table.insert().values(name=self.name, tokens=self.capacity, updated=now))
+        except IntegrityError:
+            pass
+
+
+class QuotaScheduler:
+    """Spoonacular point budget.
+
+    Every call has to fit in the daily bucket, and endpoints listed in endpoint_points
+    also have to fit in their own bucket. Background calls can't spend the last
+    background_reserve share of a bucket, which is kept for page loads. Given an
+    engine, the buckets live in the database and are shared by every process.
+    """
+
+    def __init__(self, daily_points=150, endpoint_points=None, background_reserve=0.25):
+        self.background_reserve = background_reserve
+        self.configure(daily_points, endpoint_points)
+
+    def configure(self, daily_points, endpoint_points=None, engine=None):
+        day = 60 * 60 * 24
+
+        def bucket(name, points):
+            if engine is None:
+                return TokenBucket(points, day)
+            return SharedTokenBucket(name, points, day, engine)
+
+        self.total = bucket('total', daily_points)
+        self.endpoints = {endpoint: bucket(endpoint, points) for endpoint, points in (endpoint_points or {}).items()}
+        self.spent = {}
+        self.rejected = {}
+        self._lock = Lock()
+
+    def acquire(self, endpoint, points, priority='interactive'):
+        """Spend points for one call to endpoint, or raise QuotaExceeded without spending any"""
+        buckets = [self.total]
+        if endpoint in self.endpoints:
+            buckets.insert(0, self.endpoints[endpoint])
+
+        taken = []
+        for bucket in buckets:
+            keep = bucket.capacity * self.background_reserve if priority == 'background' else 0
+            if not bucket.take(points, keep):
+                for earlier in taken:
+                    earlier.give(points)
+                with self._lock:
+                    self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+                raise QuotaExceeded(f'No Spoonacular points left for { endpoint }')
+            taken.append(bucket)
+
+        with self._lock:
+            self.spent[endpoint] = self.spent.get(endpoint, 0) + points
+
+    def stats(self):
+        remaining = self.total.level()
+        with self._lock:
+            return {
+                'remaining': remaining,
+                'spent': dict(self.spent),
+                'rejected': dict(self.rejected)
+            }
+
+
+class SingleFlight:
+    """Lets concurrent identical calls share one in-flight call"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.shared = 0
+
+    def do(self, key, func):
+        """Run func() unless a call for key is already running, in which case wait for its result"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,272 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import Lock
+from cache import load_recipe
+from models import CachedRecipe
+import math
+import re
+
+
+STOP_WORDS = {'a', 'an', 'and', 'the', 'of', 'with', 'in', 'on', 'for', 'to', 'or'}
+PANTRY_STAPLES = {'water', 'salt', 'flour'}
+
+
+def tokenize(text):
+    """Lowercase words in text, without stop words"""
+    return [word for word in re.findall(r'[a-z0-9]+', (text or '').lower()) if word not in STOP_WORDS]
+
+
+def singular(word):
+    """Very small plural stemmer, enough to match "tomatoes" with "tomato" """
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith('oes'):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us')):
+        return word[:-1]
+    return word
+
+
+def ingredient_words(name):
+    return frozenset(singular(word) for word in tokenize(name))
+
+
+def intersect(first, second):
+    """Intersect two sorted arrays of recipe ids"""
+    result = array('l')
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            result.append(first[i])
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class CachedRecipeIndex:
+    """Shared loading for the in-memory indexes over fetched recipes"""
+
+    def add_many(self, recipes):
+        for recipe_info in recipes:
+            self.add(recipe_info)
+
+    def load(self):
+        """Index everything in the recipe_cache table the first time the index is used.
+        Rows that aren't recipes are skipped, and left for recipe_cache.purge_invalid()."""
+        if self._loaded:
+            return
+
+        self.add_many(recipe_info for recipe_info in (load_recipe(cached.data) for cached in CachedRecipe.query.all())
+                      if recipe_info is not None)
+        self._loaded = True
+
+
+class RecipeSearchIndex(CachedRecipeIndex):
+    """In-process inverted index over every recipe the app has fetched.
+
+    Titles count more than dish types and cuisines, which count more than ingredients.
+    Every query word also matches words it is a prefix of, at a lower weight.
+    """
+
+    title_weight = 3
+    tag_weight = 2
+    ingredient_weight = 1
+    prefix_weight = 0.5
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._words = []
+        self._recipes = {}
+        self._loaded = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def add(self, recipe_info):
+        """Index one recipe, given as recipe information or a complexSearch result"""
+        recipe_id = recipe_info['id']
+        weights = {}
+
+        for word in tokenize(' '.join(recipe_info.get('cuisines', []) + recipe_info.get('dishTypes', []))):
+            weights[word] = max(weights.get(word, 0), self.tag_weight)
+        for ingredient in recipe_info.get('extendedIngredients', []):
+            for word in tokenize(ingredient.get('nameClean') or ingredient.get('name')):
+                weights[word] = max(weights.get(word, 0), self.ingredient_weight)
+        for word in tokenize(recipe_info.get('title')):
+            weights[word] = self.title_weight
+
+        with self._lock:
+            if recipe_id in self._recipes and len(weights) <= self._recipes[recipe_id]['words']:
+                return
+
+            self._recipes[recipe_id] = {
+                'id': recipe_id,
+                'title': recipe_info.get('title'),
+                'image': recipe_info.get('image'),
+                'imageType': recipe_info.get('imageType'),
+                'words': len(weights)
+            }
+
+            for word, weight in weights.items():
+                if word not in self._postings:
+                    insort(self._words, word)
+                self._postings[word][recipe_id] = weight
+
+    def search(self, query, limit=10):
+        """Return up to limit recipes matching every word in query, best match first"""
+        self.load()
+        words = tokenize(query)
+        if len(words) == 0:
+            return []
+
+        with self._lock:
+            total = len(self._recipes)
+            scores = None
+
+            for word in words:
+                word_scores = {}
+                for match in self._prefix_matches(word):
+                    postings = self._postings[match]
+                    idf = math.log(1 + total / len(postings))
+                    factor = 1 if match == word else self.prefix_weight
+
+                    for recipe_id, weight in postings.items():
+                        score = idf * weight * factor
+                        if score > word_scores.get(recipe_id, 0):
+                            word_scores[recipe_id] = score
+
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {recipe_id: score + word_scores[recipe_id] for recipe_id, score in scores.items() if recipe_id in word_scores}
+
+                if len(scores) == 0:
+                    return []
+
+            ranked = sorted(scores, key=lambda recipe_id: (-scores[recipe_id], recipe_id))[:limit]
+            return [{key: value for key, value in self._recipes[recipe_id].items() if key != 'words'} for recipe_id in ranked]
+
+    def _prefix_matches(self, word):
+        index = bisect_left(self._words, word)
+        matches = []
+        while index < len(self._words) and self._words[index].startswith(word):
+            matches.append(self._words[index])
+            index += 1
+        return matches
+
+
+class IngredientIndex(CachedRecipeIndex):
+    """Ingredient word to recipe id index over the extendedIngredients of fetched recipes.
+
+    Answers the same question as recipes/findByIngredients with ranking=2: recipes
+    missing the fewest ingredients first, then the ones using the most of the pantry.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._recipes = {}
+        self._loaded = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def add(self, recipe_info):
+        """Index a recipe's ingredients, skipping results that don't list them"""
+        recipe_id = recipe_info['id']
+        if 'extendedIngredients' not in recipe_info or recipe_id in self._recipes:
+            return
+
+        ingredients = []
+        for ingredient in recipe_info['extendedIngredients']:
+            words = ingredient_words(ingredient.get('nameClean') or ingredient.get('name'))
+            if len(words) == 0:
+                continue
+
+            ingredients.append((words, {
+                'id': ingredient.get('id'),
+                'name': ingredient.get('name'),
+                'amount': ingredient.get('amount'),
+                'unit': ingredient.get('unit'),
+                'original': ingredient.get('original'),
+                'image': f"https://spoonacular.com/cdn/ingredients_100x100/{ ingredient.get('image') }"
+            }))
+
+        with self._lock:
+            if recipe_id in self._recipes:
+                return
+
+            self._recipes[recipe_id] = {
+                'id': recipe_id,
+                'title': recipe_info.get('title'),
+                'image': recipe_info.get('image'),
+                'imageType': recipe_info.get('imageType'),
+                'likes': recipe_info.get('aggregateLikes', 0),
+                'ingredients': ingredients
+            }
+
+            for word in set().union(*(words for words, ingredient in ingredients)):
+                postings = self._postings.setdefault(word, array('l'))
+                insort(postings, recipe_id)
+
+    def find(self, pantry, number=10, favorites=None):
+        """Return up to number recipes using the pantry ingredients, shaped like findByIngredients results.
+
+        If favorites (a set of recipe ids) is given, each recipe also gets a 'favorite' flag.
+        """
+        self.load()
+        pantry = [words for words in (ingredient_words(name) for name in pantry) if len(words) > 0]
+
+        with self._lock:
+            candidates = set()
+            for words in pantry:
+                postings = sorted((self._postings.get(word, array('l')) for word in words), key=len)
+                matches = postings[0]
+                for other in postings[1:]:
+                    matches = intersect(matches, other)
+                candidates.update(matches)
+
+            results = []
+            for recipe_id in candidates:
+                recipe = self._recipes[recipe_id]
+                used, missed = [], []
+
+                for words, ingredient in recipe['ingredients']:
+                    if any(pantry_words <= words for pantry_words in pantry):
+                        used.append(ingredient)
+                    elif not words <= PANTRY_STAPLES:
+                        missed.append(ingredient)
+
+                """A pantry item's words can be spread over different ingredients, like "chicken breast"
+                over "chicken stock" and "duck breast", which doesn't make it a match"""
+                if not used:
+                    continue
+
+                result = {
+                    'id': recipe_id,
+                    'title': recipe['title'],
+                    'image': recipe['image'],
+                    'imageType': recipe['imageType'],
+                    'likes': recipe['likes'],
+                    'usedIngredientCount': len(used),
+                    'missedIngredientCount': len(missed),
+                    'usedIngredients': used,
+                    'missedIngredients': missed
+                }
+                if favorites is not None:
+                    result['favorite'] = recipe_id in favorites
+
+                results.append(result)
+
+        results.sort(key=lambda recipe: (recipe['missedIngredientCount'], -recipe['usedIngredientCount'], recipe['id']))
+        return results[:number]
+
+
+recipe_index = RecipeSearchIndex()
+ingredient_index = IngredientIndex()
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from blinker import Namespace
+from requests.adapters import HTTPAdapter
+from models import db
+from quota import QuotaScheduler, SingleFlight
+import re
+import requests
+import time
+
+
+signals = Namespace()
+upstream_called = signals.signal('upstream-called')
+
+"""Sent along with upstream_called as tag, including for calls made on the thread pool for the caller"""
+call_tag = ContextVar('spoonacular_call_tag', default=None)
+
+
+class SpoonacularError(requests.RequestException):
+    """Spoonacular answered with an error instead of data"""
+
+
+class SpoonacularClient:
+    """Shared Spoonacular API client.
+
+    All requests go through one keep-alive session, and requests for many ids are
+    either sent to a bulk endpoint or fanned out over a bounded thread pool.
+    Identical concurrent requests share one call, and every call is charged to
+    the quota scheduler first.
+    """
+
+    base_url = 'https://api.spoonacular.com'
+    bulk_size = 50
+
+    def __init__(self, api_key=None, pool_size=10, max_workers=8, timeout=10):
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._session = None
+        self._executor = None
+        self.quota = QuotaScheduler()
+        self.flights = SingleFlight()
+
+    def init_app(self, app):
+        """Read the API key and pool sizes from the app config"""
+        self.api_key = app.config.get('SPOONACULAR_KEY', self.api_key)
+        self.base_url = app.config.setdefault('SPOONACULAR_URL', self.base_url)
+        self.pool_size = app.config.setdefault('SPOONACULAR_POOL_SIZE', self.pool_size)
+        self.max_workers = app.config.setdefault('SPOONACULAR_MAX_WORKERS', self.max_workers)
+        self.timeout = app.config.setdefault('SPOONACULAR_TIMEOUT', self.timeout)
+        self.quota.background_reserve = app.config.setdefault('SPOONACULAR_BACKGROUND_RESERVE', self.quota.background_reserve)
+        with app.app_context():
+            engine = db.engine
+        self.quota.configure(app.config.setdefault('SPOONACULAR_DAILY_POINTS', self.quota.total.capacity),
+                             app.config.setdefault('SPOONACULAR_ENDPOINT_POINTS', {}),
+                             engine if app.config.setdefault('SPOONACULAR_SHARED_QUOTA', True) else None)
+
+    def reset(self):
+        """Forget the session and thread pool, so a forked worker makes its own"""
+        self._session = None
+        self._executor = None
+        self.flights = SingleFlight()
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='spoonacular')
+        return self._executor
+
+    def get(self, path, priority='interactive', **params):
+        """GET an API path and return the decoded JSON.
+
+        priority is 'interactive' for page loads or 'background' for prefetching, which
+        can't use the share of the quota kept for page loads. Only calls with the same
+        priority share a flight, so a page load never gets a background call's QuotaExceeded.
+        """
+        key = (path, priority, tuple(sorted(params.items())))
+        return self.flights.do(key, lambda: self._request(path, priority, params))
+
+    def _request(self, path, priority, params):
+        endpoint = re.sub(r'/\d+', '/{id}', path)
+        self.quota.acquire(endpoint, self.points(params), priority)
+
+        params = {**params, 'apiKey': self.api_key}
+        started = time.perf_counter()
+        try:
+            res = self.session.get(f'{ self.base_url }{ path }', params=params, timeout=self.timeout)
+        finally:
+            upstream_called.send(self, path=path, duration=time.perf_counter() - started, tag=call_tag.get())
+
+        res.raise_for_status()
+        data = res.json()
+
+        """Errors like a used up plan come back as {"status": "failure", "code": 402, ...}.
+        A failure without a code, like no substitutes found, is an ordinary answer."""
+        if isinstance(data, dict) and data.get('status') == 'failure' and 'code' in data:
+            raise SpoonacularError(f"Spoonacular { data['code'] } for { endpoint }: { data.get('message') }", response=res)
+        return data
+
+    @staticmethod
+    def points(params):
+        """Roughly what Spoonacular charges for a call: 1 point, plus extra per bulk id or result"""
+        points = 1
+        if 'ids' in params:
+            points += 0.5 * (len(str(params['ids']).split(',')) - 1)
+        if 'number' in params:
+            points += 0.01 * int(params['number'])
+        return points
+
+    def submit(self, func, *args):
+        """Run func(*args) on the thread pool and return its future"""
+        return self.executor.submit(self._tagged(func), *args)
+
+    def map(self, func, items):
+        """Run func over items on the thread pool, keeping the order of items"""
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        return list(self.executor.map(self._tagged(func), items))
+
+    @staticmethod
+    def _tagged(func):
+        """Wrap func to run with the caller's call_tag, so its calls are credited to the caller"""
+        tag = call_tag.get()
+
+        def run(*args):
+            token = call_tag.set(tag)
+            try:
+                return func(*args)
+            finally:
+                call_tag.reset(token)
+        return run
+
+    def recipe_information(self, recipe_id):
+        return self.get(f'/recipes/{ recipe_id }/information')
+
+    def recipe_information_bulk(self, recipe_ids, priority='interactive'):
+        """Get info for many recipes with as few informationBulk calls as possible"""
+        recipe_ids = [int(id) for id in recipe_ids]
+        chunks = [recipe_ids[i:i + self.bulk_size] for i in range(0, len(recipe_ids), self.bulk_size)]
+
+        def fetch_chunk(chunk):
+            return self.get('/recipes/informationBulk', priority=priority, ids=','.join(str(id) for id in chunk))
+
+        recipes = []
+        for chunk in self.map(fetch_chunk, chunks):
+            recipes.extend(chunk)
+        return recipes
+
+    def ingredient_information(self, ingredient_id):
+        return self.get(f'/food/ingredients/{ ingredient_id }/information')
+
+    def ingredient_information_many(self, ingredient_ids):
+        """Get info for many ingredients concurrently, returned in the same order as the ids"""
+        return self.map(self.ingredient_information, ingredient_ids)
+
+
+spoonacular = SpoonacularClient()